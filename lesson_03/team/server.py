@@ -24,6 +24,9 @@ import threading
 import time
 import json
 import os
+import argparse
+
+import latency
 
 TOP_API_URL = 'http://127.0.0.1:8790'
 
@@ -36,6 +39,11 @@ URL_STARSHIPS = "starships"
 
 DELAY = 0.5         # Delay
 
+# LatencyModel from the command line (latency.py), None: every request sleeps DELAY
+latency_model = None
+# --verbose: print the capacity queue after every delay
+verbose = False
+
 master_dict = {}
 
 class Handler(BaseHTTPRequestHandler):
@@ -47,7 +55,13 @@ class Handler(BaseHTTPRequestHandler):
         # self.path => "/people/1"
 
         # delay the reply from the server
-        time.sleep(DELAY)
+        if latency_model is not None:
+            latency_model.wait(latency.endpoint_of(self.path))
+            if verbose and latency_model.capacity > 0:
+                queue = latency_model.metrics()
+                print(f'Capacity queue: {queue["waiting"]} waiting, max {queue["max_waiting"]}')
+        else:
+            time.sleep(DELAY)
 
         # check to top level URL
         if self.path == '/':
@@ -105,6 +119,17 @@ class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
 
 def run():
     global master_dict
+    global latency_model
+    global verbose
+
+    parser = argparse.ArgumentParser(description='Star Wars server')
+    latency.add_arguments(parser, DELAY)
+    parser.add_argument('--verbose', action='store_true',
+                        help='print the capacity queue after every delay (with --capacity)')
+    args = parser.parse_args()
+    latency_model = latency.from_args(parser, args)
+    verbose = args.verbose
+    print(f'Latency: {latency_model}')
 
     if not os.path.exists('data.json'):
         print('Error the file "data.json" not found')
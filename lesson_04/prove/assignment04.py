@@ -15,19 +15,40 @@ where:
 name: name of the city
 recno: record number starting from 0
 
+Many records can be retrieved with one call (up to RECORDS_PAGE):
+
+f'{TOP_API_URL}/records/{name}/{start}/{count}
+
+get_records_page(name, start, count) in common.py returns them as a list of
+(date, temp) and get_records_from_server(name, start, count) gets any number
+of records one page at a time.
+
 """
 
 import time
+import math
 from common import *
 import threading
 import queue
 
 from cse351 import *
 
-THREADS = 1000
-WORKERS = 1000
+THREADS = 50       # one for every page: 10 cities * 5000 records / RECORDS_PAGE
+WORKERS = 10
+TASK_QUEUE_SIZE = 10
+RESULT_QUEUE_SIZE = 10
 RECORDS_TO_RETRIEVE = 5000  # Don't change
 
+AUTO_TUNE = True            # measure the server first and pick the values above (see auto_tune())
+PROBE_PAGES = 2             # pages fetched one at a time to measure
+PROBE_WIDTH = 8             # then this many pages fetched at the same time
+MAX_THREADS = POOL_SIZE     # no more retrievers than pooled connections
+WORKER_HEADROOM = 2.0       # workers for this many times the measured storing load
+
+NOAA_MODE = 'stream'        # 'stream': running statistics per city, 'list': keep every temperature
+QUANTILES = True            # 'stream' mode: also keep a t-digest per city for the percentiles
+TDIGEST_COMPRESSION = 100   # more centroids, more accurate percentiles
+
 
 # ---------------------------------------------------------------------------
 def retrieve_weather_data(task_queue, result_queue):
@@ -38,14 +59,11 @@ def retrieve_weather_data(task_queue, result_queue):
             task_queue.task_done()
             break
 
-        city, recno = task
-        record = get_data_from_server(f'{TOP_API_URL}/record/{city}/{recno}')
-
-        city_name = city
-        date = record['date']
-        temp = record['temp']
+        # one page of records per call instead of one record
+        city, start, count = task
+        records = get_records_page(city, start, count)
 
-        result_queue.put((city_name, record.get("date"), record.get("temp")))
+        result_queue.put((city, records))
         task_queue.task_done()
 
 
@@ -64,29 +82,165 @@ class Worker(threading.Thread):
             if data is None or data == "DONE":
                 self.result_queue.task_done()
                 break
-            city, date, temp = data
-            self.noaa.store(city, date, temp)
+            city, records = data
+            # one update for the whole page (None: the page failed)
+            if records is not None:
+                self.noaa.store_many(city, [temp for _, temp in records])
             self.result_queue.task_done()
 
 
+# ---------------------------------------------------------------------------
+class TDigest:
+    """
+    Merging t-digest: temperatures are collected in a buffer and merged
+    into at most about compression centroids (mean, weight), small ones
+    near the ends so the tail percentiles stay accurate.  Memory doesn't
+    grow with the number of temperatures.
+    """
+
+    def __init__(self, compression=TDIGEST_COMPRESSION):
+        self.compression = compression
+        self.centroids = []         # [mean, weight] sorted by mean
+        self.buffer = []
+        self.count = 0
+
+    def add(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= 5 * self.compression:
+            self._merge()
+
+    def _scale(self, q):
+        # k1 scale function, one centroid may cover at most 1 of k
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _merge(self):
+        points = sorted(self.centroids + [[value, 1] for value in self.buffer])
+        self.buffer = []
+        self.count = sum(weight for _, weight in points)
+        merged = [list(points[0])]
+        seen = 0
+        k_left = self._scale(0)
+        for mean, weight in points[1:]:
+            last = merged[-1]
+            if self._scale((seen + last[1] + weight) / self.count) - k_left <= 1:
+                last[0] += (mean - last[0]) * weight / (last[1] + weight)
+                last[1] += weight
+            else:
+                seen += last[1]
+                k_left = self._scale(seen / self.count)
+                merged.append([mean, weight])
+        self.centroids = merged
+
+    def quantile(self, q):
+        """ Temperature at quantile q (0..1), None without any values """
+        if self.buffer:
+            self._merge()
+        if not self.centroids:
+            return None
+        rank = q * self.count
+        seen = 0
+        previous = None
+        for mean, weight in self.centroids:
+            middle = seen + weight / 2
+            if rank < middle:
+                if previous is None:
+                    return mean
+                # interpolate between the middles of the two centroids
+                previous_mean, previous_middle = previous
+                return previous_mean + (mean - previous_mean) * (rank - previous_middle) / (middle - previous_middle)
+            previous = (mean, middle)
+            seen += weight
+        return self.centroids[-1][0]
+
+
+class CityStats:
+    """
+    Running count, mean, variance (Welford), min and max of one city.  The
+    mean is reported from a running total so it is the same as sum() / len().
+    """
+
+    def __init__(self, quantiles=QUANTILES):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0               # sum of squared differences from the mean
+        self.min = math.inf
+        self.max = -math.inf
+        self.digest = TDigest() if quantiles else None
+
+    def add_many(self, temps):
+        with self.lock:
+            for temp in temps:
+                self.count += 1
+                self.total += temp
+                delta = temp - self.mean
+                self.mean += delta / self.count
+                self.m2 += delta * (temp - self.mean)
+                if temp < self.min:
+                    self.min = temp
+                if temp > self.max:
+                    self.max = temp
+                if self.digest is not None:
+                    self.digest.add(temp)
+
+    def get_mean(self):
+        with self.lock:
+            return self.total / self.count if self.count else 0.0
+
+    def summary(self, quantiles=False):
+        """ quantiles=True also has p50, p90 and p99, which merge the t-digest """
+        with self.lock:
+            data = {'count': self.count, 'mean': self.total / self.count if self.count else 0.0,
+                    'stdev': math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0,
+                    'min': self.min, 'max': self.max}
+            if quantiles and self.digest is not None:
+                for percent in (50, 90, 99):
+                    data[f'p{percent}'] = self.digest.quantile(percent / 100)
+            return data
+
+
 # ---------------------------------------------------------------------------
 # TODO - Complete this class
 class NOAA:
-    def __init__(self):
-        self.results = {city: [] for city in CITIES}
+    """
+    NOAA_MODE 'stream' keeps a CityStats per city, each with its own lock,
+    so memory stays the same however many records are stored and workers
+    on different cities never wait for each other.  'list' keeps every
+    temperature behind one lock.
+    """
+
+    def __init__(self, mode=NOAA_MODE):
+        self.mode = mode
+        if mode == 'stream':
+            self.results = {city: CityStats() for city in CITIES}
+        else:
+            self.results = {city: [] for city in CITIES}
         self.lock = threading.Lock()
 
     def store(self, city, date, temp):
+        self.store_many(city, [temp])
+
+    def store_many(self, city, temps):
+        if self.mode == 'stream':
+            self.results[city].add_many([float(temp) for temp in temps])
+            return
         with self.lock:
-            self.results[city].append((float(temp)))
+            self.results[city].extend(float(temp) for temp in temps)
 
     def get_temp_details(self, city):
+        if self.mode == 'stream':
+            return self.results[city].get_mean() if city in self.results else 0.0
         with self.lock:
             temps = self.results.get(city, [])
             if not temps:
                 return 0.0
             return sum(temps) / len(temps)
 
+    def get_summaries(self, quantiles=False):
+        """ {city: CityStats.summary(quantiles)}, 'stream' mode only """
+        return {city: stats.summary(quantiles) for city, stats in self.results.items()}
+
 
 # ---------------------------------------------------------------------------
 def verify_noaa_results(noaa):
@@ -119,6 +273,130 @@ def verify_noaa_results(noaa):
     print('===================================')
 
 
+def probe(noaa, tasks):
+    """
+    Fetches and stores tasks all at the same time.  Returns the wall time
+    until the last page arrived (the slowest page, not the mean one), the
+    mean store time and the tasks whose page failed.  Both times are None
+    when no page arrived.
+    """
+    times = []
+    failed = []
+    lock = threading.Lock()
+
+    def _fetch(city, start, count):
+        records = get_records_page(city, start, count)
+        fetched = time.perf_counter()
+        if records is None:
+            with lock:
+                failed.append((city, start, count))
+            return
+        noaa.store_many(city, [temp for _, temp in records])
+        with lock:
+            times.append((fetched, time.perf_counter() - fetched))
+
+    begin = time.perf_counter()
+    threads = [threading.Thread(target=_fetch, args=task) for task in tasks]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if not times:
+        return None, None, failed
+    return max(f for f, _ in times) - begin, sum(c for _, c in times) / len(times), failed
+
+
+def default_settings():
+    """ The pool and queue sizes set at the top of the file """
+    return {'threads': THREADS, 'workers': WORKERS, 'task_queue': TASK_QUEUE_SIZE,
+            'result_queue': RESULT_QUEUE_SIZE, 'predicted_calls_per_second': None}
+
+
+def auto_tune(noaa, tasks):
+    """
+    Measures the server with real tasks (their records are stored).  L(n)
+    is the time until the last of n pages fetched at the same time arrives:
+
+      alone : PROBE_PAGES pages one at a time, L(1) and the cost C of
+              storing a page
+      wide  : PROBE_WIDTH pages at the same time, L(w) while the server is
+              busy with w of them
+
+    L grows by s = (L(w) - L(1)) / (w - 1) for every page in flight (a
+    saturated server), so L(n) = L(1) + s * (n - 1).  Little's law gives the
+    throughput, n / L(n) pages per second, and the retrievers are the n (up
+    to MAX_THREADS) that fetch the remaining N pages in the least time,
+    ceil(N / n) rounds of L(n).
+
+      workers : pages arrive at n / L(n) per second and each keeps a worker
+                busy C seconds, so n / L(n) * C workers are busy (times
+                WORKER_HEADROOM)
+      queues  : one task waiting for every retriever and room for every
+                retriever's result, so a retriever never waits to put
+
+    A page that fails is not measured and goes back with the tasks still
+    to do.  Without any page alone to measure, the settings are
+    default_settings() and the wide probe is skipped.
+
+    Returns (settings, the tasks not probed or failed)
+    """
+    alone = tasks[:PROBE_PAGES]
+    wide = tasks[len(alone):len(alone) + PROBE_WIDTH]
+    remaining = tasks[len(alone) + len(wide):]
+
+    results = []
+    failed = []
+    for task in alone:
+        page_latency, consumer, lost = probe(noaa, [task])
+        failed.extend(lost)
+        if page_latency is not None:
+            results.append((page_latency, consumer))
+    if not results:
+        return default_settings(), failed + wide + remaining
+    latency = sum(l for l, _ in results) / len(results)
+    consumer = sum(c for _, c in results) / len(results)
+
+    wide_latency = latency
+    slope = 0.0
+    arrived = len(wide)
+    if len(wide) > 1:
+        wide_latency, _, lost = probe(noaa, wide)
+        failed.extend(lost)
+        # only the pages that arrived were in flight until the last one
+        arrived -= len(lost)
+        if wide_latency is None or arrived < 2:
+            wide_latency = latency
+        else:
+            slope = max(0.0, (wide_latency - latency) / (arrived - 1))
+    remaining = failed + remaining
+
+    def _latency(n):
+        return latency + slope * (n - 1)
+
+    def _total_time(n):
+        return math.ceil(len(remaining) / n) * _latency(n)
+
+    # the fewest retrievers of those with the least total time
+    threads = min(range(1, max(1, min(MAX_THREADS, len(remaining))) + 1), key=lambda n: (_total_time(n), n))
+    pages_per_second = threads / _latency(threads) if latency > 0 else 0.0
+    workers = max(1, math.ceil(pages_per_second * consumer * WORKER_HEADROOM))
+    predicted = len(remaining) / _total_time(threads) if remaining and latency > 0 else None
+    settings = {'threads': threads, 'workers': workers, 'task_queue': threads, 'result_queue': threads,
+                'latency': latency, 'wide_latency': wide_latency, 'wide': arrived, 'slope': slope,
+                'consumer': consumer, 'expected_latency': _latency(threads),
+                'predicted_calls_per_second': predicted}
+    return settings, remaining
+
+
+def print_noaa_summaries(noaa):
+    columns = ('count', 'mean', 'stdev', 'min', 'max') + (('p50', 'p90', 'p99') if QUANTILES else ())
+    print()
+    print(f'{"City":>15}: ' + ' '.join(f'{column:>8}' for column in columns))
+    for name, summary in noaa.get_summaries(QUANTILES).items():
+        print(f'{name:>15}: ' + ' '.join(f'{summary[column]:>8.2f}' if column != 'count' else f'{summary[column]:>8}'
+                                          for column in columns))
+
+
 # ---------------------------------------------------------------------------
 def main():
 
@@ -142,28 +420,43 @@ def main():
     print('===================================')
 
     records = RECORDS_TO_RETRIEVE
+    tasks = [(city, start, min(RECORDS_PAGE, records - start))
+             for city in CITIES for start in range(0, records, RECORDS_PAGE)]
+
+    if AUTO_TUNE:
+        settings, tasks = auto_tune(noaa, tasks)
+        if 'latency' not in settings:
+            print('Auto tune: no probe page arrived, using the default sizes')
+        else:
+            print(f'Auto tune: page latency {settings["latency"] * 1000:.1f} ms alone, last of '
+                  f'{settings["wide"]} in flight {settings["wide_latency"] * 1000:.1f} ms '
+                  f'(+{settings["slope"] * 1000:.2f} ms per page), store {settings["consumer"] * 1000:.3f} ms per page')
+    else:
+        settings = default_settings()
+    print(f'Retrievers {settings["threads"]}, workers {settings["workers"]}, '
+          f'queues {settings["task_queue"]} tasks / {settings["result_queue"]} results')
 
     # TODO - Create any queues, pipes, locks, barriers you need
-    task_queue = queue.Queue(maxsize=10)
-    result_queue = queue.Queue(maxsize=10)
+    task_queue = queue.Queue(maxsize=settings['task_queue'])
+    result_queue = queue.Queue(maxsize=settings['result_queue'])
     
+    fetch_start = time.perf_counter()
     retrievers = []
-    for _ in range(THREADS):
+    for _ in range(settings['threads']):
         t = threading.Thread(target=retrieve_weather_data, args=(task_queue, result_queue))
         t.start()
         retrievers.append(t)
     
    
     workers = []
-    for i in range(WORKERS):
+    for i in range(settings['workers']):
         w = Worker(result_queue, noaa)
         w.start()
         workers.append(w)
 
     
-    for city in CITIES:
-        for recno in range(records):
-            task_queue.put((city, recno))
+    for task in tasks:
+        task_queue.put(task)
 
     for _ in retrievers:
         task_queue.put("DONE")
@@ -177,12 +470,26 @@ def main():
         t.join(timeout=1)
     for w in workers:
         w.join(timeout=1)
+    fetch_time = time.perf_counter() - fetch_start
 
     # End server - don't change below
     data = get_data_from_server(f'{TOP_API_URL}/end')
     print(data)
     
     verify_noaa_results(noaa)
+    if noaa.mode == 'stream':
+        print_noaa_summaries(noaa)
+
+    predicted = settings['predicted_calls_per_second']
+    print()
+    print(f'Page calls per second  : {len(tasks) / fetch_time:.1f} achieved'
+          + (f', {predicted:.1f} predicted' if predicted else ''))
+    # a gap to the prediction means the latency didn't grow the way the probes measured
+    calls = get_session_stats()
+    print(f'Call latency p50 / p99 : {calls["p50"] * 1000:.1f} / {calls["p99"] * 1000:.1f} ms'
+          + (f' ({settings["expected_latency"] * 1000:.1f} ms expected for the last)' if predicted else ''))
+    if data:
+        print(f'Server calls per second: {data["calls_per_second"]:.1f} (all {data["api"]} calls, /end)')
 
     log.stop_timer('Run time: ')
 
@@ -0,0 +1,101 @@
+"""
+Course: CSE 351
+Lesson Week: 4
+File: bench_responses.py
+Purpose: Assignment 4 - Weather Program, reply serialization benchmark
+
+Instructions:
+
+Run "python bench_responses.py" in the folder with server.py.
+The server doesn't need to be running.
+
+The server used to build a reply by formatting a Python literal string,
+parsing it with ast.literal_eval() and dumping it again with json.dumps(),
+from the JSON lists of the .dat files.  This times every reply both ways:
+the old code (rebuilt here) and the functions server.py runs now
+(get_city_json, get_record_json, get_records_json and get_end_json, on
+the mapped city columns).  Both must give the same reply.  The old
+/records joined strings dumped once per record at /start, before the
+server had the city columns.
+
+Times are per reply (per record for /records), the best of REPEATS runs.
+"""
+
+import ast
+import json
+import timeit
+
+import server
+
+NUMBER = 20000
+REPEATS = 5             # best of
+CITY = 'san_antonio'
+RECORD = 1234
+RECORDS_PAGE = 1000     # records in a /records reply
+
+
+def format_date(date_str):
+    # the old server.format_date(): "mmdd hhmmss" -> "mm-dd hh:mm:ss"
+    return date_str[:2] + '-' + date_str[2:4] + ' ' + date_str[5:7] + ':' + date_str[7:9] + ':' + date_str[9:]
+
+
+def load_old_data():
+    filename = dict(server.CITIES)[CITY]
+    with open(server.DATA_FOLDER + filename, 'r') as f:
+        data = json.load(f)
+    return data, [json.dumps([format_date(date_str), temp]) for date_str, temp in data]
+
+
+def main():
+    server.load_cities()
+    data, data_json = load_old_data()
+    summary = server.stats.summary()
+    total_time = 12.5
+
+    def old_city():
+        data_str = '{' + f'"status":"OK", "city": "{CITY}", "records": {len(data)}' + '}'
+        return bytes(json.dumps(ast.literal_eval(data_str)), 'utf8')
+
+    def old_record():
+        date_str = format_date(data[RECORD][0])
+        temp = data[RECORD][1]
+        data_str = '{' + f'"status":"OK", "city": "{CITY}", "date": "{date_str}", "temp": {temp}' + '}'
+        return bytes(json.dumps(ast.literal_eval(data_str)), 'utf8')
+
+    def old_records():
+        records = data_json[0:RECORDS_PAGE]
+        return bytes(f'{{"status": "OK", "city": "{CITY}", "start": 0, "count": {len(records)}, '
+                     f'"records": [{", ".join(records)}]}}', 'utf8')
+
+    def old_end():
+        calls = server.call_count
+        data_str = '{' + \
+                   f'"status":"OK", "api": {calls}, "threads": {server.max_thread_count}, "total_time": {total_time}, "calls_per_second": {calls / total_time}, "connections": {server.connection_count}' + \
+                   '}'
+        end = ast.literal_eval(data_str)
+        end['mode'] = server.SERVER_MODE
+        end['log_dropped'] = server.log.dropped
+        end.update(summary)
+        return bytes(json.dumps(end), 'utf8')
+
+    replies = (
+        # reply, old, new, records per reply
+        ('/city', old_city, lambda: server.get_city_json(CITY), 1),
+        ('/record', old_record, lambda: server.get_record_json(CITY, RECORD), 1),
+        ('/records', old_records, lambda: server.get_records_json(CITY, 0, RECORDS_PAGE), RECORDS_PAGE),
+        ('/end', old_end, lambda: server.get_end_json(total_time, summary), 1),
+    )
+
+    print(f'{"Reply":<10} {"Old (us)":>10} {"New (us)":>10} {"Speedup":>8}')
+    for reply, old, new, size in replies:
+        if old() != new():
+            raise SystemExit(f'{reply}: the replies are not the same\n{old()[:200]}\n{new()[:200]}')
+        number = max(10, NUMBER // size)
+        old_time = min(timeit.repeat(old, number=number, repeat=REPEATS)) / number
+        new_time = min(timeit.repeat(new, number=number, repeat=REPEATS)) / number
+        print(f'{reply:<10} {old_time / size * 1e6:>10.3f} {new_time / size * 1e6:>10.3f} '
+              f'{old_time / new_time:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Course: CSE 351
+Lesson Week: 4
+File: city_store.py
+Purpose: Preparsed, memory-mapped city data for the NOAA server
+
+The .dat files are JSON lists of ["mmdd hhmmss", temp].  Parsing all of
+them took most of the time of every /start, so they are converted once
+into a column file per city in CACHE_FOLDER:
+
+  header   : MAGIC, version, record count, temp typecode, .dat size and mtime
+  dates    : int32 per record, "0227 210710" -> 227210710 (mmddhhmmss)
+  temps    : int32 per record ('i'), or float64 ('d') if any temp isn't whole
+
+A column file is rebuilt when its .dat file changes.  The server maps the
+files once and reads the records straight from the mapped columns, so a
+request never parses anything.  The JSON of every record is also built
+once when a file is mapped, so a /records page is only a slice and a join.
+
+Run "python city_store.py" to (re)build the column files by hand.
+"""
+
+import array
+import json
+import mmap
+import os
+import struct
+import sys
+
+DATA_FOLDER = 'data/'
+CACHE_FOLDER = DATA_FOLDER + 'cache/'
+
+MAGIC = b'NOAA'
+VERSION = 1
+# magic, version, count, temp typecode, padding, .dat size, .dat mtime (ns)
+HEADER = struct.Struct('<4sIIc3xqq')
+ALIGN = 8
+
+
+def _aligned(size):
+    return (size + ALIGN - 1) // ALIGN * ALIGN
+
+
+def pack_date(date_str):
+    """ "mmdd hhmmss" -> mmddhhmmss """
+    return int(date_str[:4] + date_str[5:])
+
+
+def format_date(date):
+    """ mmddhhmmss -> "mm-dd hh:mm:ss" """
+    return f'{date // 100000000:02}-{date // 1000000 % 100:02} {date // 10000 % 100:02}:{date // 100 % 100:02}:{date % 100:02}'
+
+
+class CityColumns:
+    """ The records of one city, read from the mapped column file """
+
+    def __init__(self, name, buffer):
+        magic, version, count, typecode, _, _ = HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{name}: not a version {VERSION} column file')
+        self.name = name
+        self.buffer = buffer
+        view = memoryview(buffer)
+        dates_at = _aligned(HEADER.size)
+        temps_at = dates_at + _aligned(4 * count)
+        self.dates = view[dates_at:dates_at + 4 * count].cast('i')
+        typecode = typecode.decode()
+        self.temps = view[temps_at:temps_at + struct.calcsize(typecode) * count].cast(typecode)
+        # '["mm-dd hh:mm:ss", temp]' of every record (str joins faster than bytes)
+        self.json = [f'["{format_date(date)}", {temp}]' for date, temp in zip(self.dates, self.temps)]
+
+    def __len__(self):
+        return len(self.dates)
+
+    def record(self, index):
+        """ ("mm-dd hh:mm:ss", temp) of one record, IndexError when out of range """
+        return format_date(self.dates[index]), self.temps[index]
+
+    def records_json(self, first, count):
+        """ '["mm-dd hh:mm:ss", temp]' of a range of records """
+        return self.json[first:first + count]
+
+
+def _source_stamp(source):
+    info = os.stat(source)
+    return info.st_size, info.st_mtime_ns
+
+
+def is_current(source, target):
+    """ True when target is a column file built from the current source """
+    try:
+        with open(target, 'rb') as f:
+            header = f.read(HEADER.size)
+        magic, version, _, _, size, mtime = HEADER.unpack(header)
+    except (OSError, struct.error):
+        return False
+    return magic == MAGIC and version == VERSION and (size, mtime) == _source_stamp(source)
+
+
+def convert(source, target):
+    """ Parses one .dat file and writes its column file """
+    with open(source, 'r') as f:
+        records = json.load(f)
+
+    dates = array.array('i', (pack_date(date_str) for date_str, _ in records))
+    whole = all(isinstance(temp, int) for _, temp in records)
+    temps = array.array('i' if whole else 'd', (temp for _, temp in records))
+
+    size, mtime = _source_stamp(source)
+    header = HEADER.pack(MAGIC, VERSION, len(records), temps.typecode.encode(), size, mtime)
+
+    # write to a temporary file first so a running server never maps half a file
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    temp_name = f'{target}.{os.getpid()}.tmp'
+    with open(temp_name, 'wb') as f:
+        for data in (header, dates.tobytes(), temps.tobytes()):
+            f.write(data)
+            f.write(bytes(_aligned(len(data)) - len(data)))
+    os.replace(temp_name, target)
+    return len(records)
+
+
+def map_city(name, target):
+    with open(target, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return CityColumns(name, buffer)
+
+
+def load_cities(cities, data_folder=DATA_FOLDER, cache_folder=CACHE_FOLDER, log=print):
+    """
+    Maps the column file of every (name, filename) in cities, converting a
+    .dat file first when its column file is missing or out of date.
+    Returns {name: CityColumns}.
+    """
+    if sys.byteorder != 'little':
+        raise RuntimeError('The column files are little-endian')
+    columns = {}
+    for name, filename in cities:
+        source = os.path.join(data_folder, filename)
+        target = os.path.join(cache_folder, os.path.splitext(filename)[0] + '.col')
+        if not is_current(source, target):
+            count = convert(source, target)
+            log(f'Converted {source} -> {target} ({count} records)')
+        columns[name] = map_city(name, target)
+    return columns
+
+
+if __name__ == '__main__':
+    dat_files = sorted(f for f in os.listdir(DATA_FOLDER) if f.endswith('.dat'))
+    for name, city in load_cities([(os.path.splitext(f)[0], f) for f in dat_files]).items():
+        print(f'{name:<14} {len(city):>7} records, first {city.record(0)}')
@@ -12,9 +12,11 @@ Common data for the assignment
 """
 
 import time
+import random
 import threading
 import json
 import requests
+import requests.adapters
 
 from cse351 import *
 
@@ -34,27 +36,172 @@ CITIES = (
 )
 
 # ----------------------------------------------------------------------------
-def get_data_from_server(url):
-    retries = 50
-    delay = 0.01 # seconds
-    for i in range(retries):
-        try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            if response.status_code == 200 and response.json() is not None:
-                return response.json()
-            break
+# Pooled HTTP session shared by every thread that calls get_data_from_server()
+#
+# One requests.Session keeps keep-alive connections in a pool per host, so
+# calls reuse sockets instead of opening (and leaving in TIME_WAIT) a new
+# connection for every record.
+
+POOL_SIZE = 100         # keep-alive connections kept per host
+POOL_BLOCK = False      # True: threads wait for a free connection instead of opening extra ones
+RETRIES = 50
+BACKOFF_BASE = 0.01     # seconds, largest delay for the first retry
+BACKOFF_MAX = 1.0       # seconds, largest delay for any retry
+MAX_LATENCY_SAMPLES = 10000
+
+
+class LatencyStats:
+    """ Thread-safe call counters and latency samples (seconds) """
 
-        except requests.exceptions.ConnectionError as e:
-            if i < retries - 1:
-                time.sleep(delay)
+    def __init__(self, max_samples=MAX_LATENCY_SAMPLES):
+        self.lock = threading.Lock()
+        self.max_samples = max_samples
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = 0
+            self.errors = 0
+            self.retries = 0
+            self.total_time = 0.0
+            self.max_time = 0.0
+            self.samples = []
+
+    def add_call(self, seconds, ok):
+        with self.lock:
+            self.calls += 1
+            if not ok:
+                self.errors += 1
+            self.total_time += seconds
+            if seconds > self.max_time:
+                self.max_time = seconds
+            # reservoir sampling keeps memory bounded on long runs
+            if len(self.samples) < self.max_samples:
+                self.samples.append(seconds)
             else:
-                print("Max retries reached. Failing.")
-                
-        except requests.exceptions.Timeout:
-            ...
-            
-        except requests.exceptions.RequestException as e:
-            break
+                index = random.randrange(self.calls)
+                if index < self.max_samples:
+                    self.samples[index] = seconds
+
+    def add_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def summary(self):
+        with self.lock:
+            samples = sorted(self.samples)
+            calls = self.calls
+            result = {
+                'calls': calls,
+                'errors': self.errors,
+                'retries': self.retries,
+                'avg': self.total_time / calls if calls else 0.0,
+                'max': self.max_time,
+            }
+
+        def _percentile(p):
+            if not samples:
+                return 0.0
+            return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+        result['p50'] = _percentile(0.50)
+        result['p99'] = _percentile(0.99)
+        return result
+
+
+class PooledSession:
+    """ requests.Session with a bounded connection pool and retry backoff """
+
+    def __init__(self, pool_size=POOL_SIZE, pool_block=POOL_BLOCK):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=pool_size, pool_block=pool_block)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.stats = LatencyStats()
+
+    def backoff(self, attempt):
+        # exponential backoff with full jitter
+        self.stats.add_retry()
+        time.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)))
+
+    def get_json(self, url, retries=RETRIES, timeout=10):
+        start = time.perf_counter()
+        data = None
+        for i in range(retries):
+            try:
+                response = self.session.get(url, timeout=timeout)
+                response.raise_for_status()
+                if response.status_code == 200:
+                    data = response.json()
+                break
+
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if i < retries - 1:
+                    self.backoff(i)
+                else:
+                    print("Max retries reached. Failing.")
+
+            except requests.exceptions.RequestException as e:
+                break
 
-    return None
\ No newline at end of file
+        self.stats.add_call(time.perf_counter() - start, data is not None)
+        return data
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = PooledSession()
+    return _session
+
+
+def configure_session(pool_size=POOL_SIZE, pool_block=POOL_BLOCK):
+    """ Replace the shared session, call before starting any threads """
+    global _session
+    with _session_lock:
+        _session = PooledSession(pool_size, pool_block)
+    return _session
+
+
+def get_session_stats():
+    return get_session().stats.summary()
+
+# ----------------------------------------------------------------------------
+def get_data_from_server(url):
+    return get_session().get_json(url)
+
+# ----------------------------------------------------------------------------
+RECORDS_PAGE = 1000     # records per /records call, must not be larger than MAX_RECORDS_PAGE in server.py
+
+
+def get_records_page(city, start, count):
+    """ One /records call: up to count (date, temp) records of city from record start """
+    data = get_data_from_server(f'{TOP_API_URL}/records/{city}/{start}/{count}')
+    if data is None:
+        return None
+    return [(date, temp) for date, temp in data['records']]
+
+
+def get_records_from_server(city, start, count, page_size=RECORDS_PAGE):
+    """
+    count (date, temp) records of city from record start, in pages of
+    page_size records (one API call each).  Returns fewer records if the
+    city has fewer, None if a page failed.
+    """
+    records = []
+    end = start + count
+    while start < end:
+        page = get_records_page(city, start, min(page_size, end - start))
+        if page is None:
+            return None
+        if not page:
+            break
+        records.extend(page)
+        start += len(page)
+    return records
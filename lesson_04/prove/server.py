@@ -27,31 +27,71 @@ API
 /end
 /city/{city}
 /record/{city}/{recno}`
+/records/{city}/{start}/{count}   (up to MAX_RECORDS_PAGE records in one call)
+/stats  (?format=prometheus, ?reset=1)
+
+python server.py --mode pool --workers 64 --queue 256   (fixed worker pool)
 
 """
 
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
 import datetime
-import json
 import time
 import random
 import threading
-import ast
+import collections
+import atexit
+import queue
+import argparse
+from urllib.parse import urlsplit, parse_qs
+
+import latency
+import city_store
+from responses import OK, Raw, Template
+from route_stats import RouteMetrics
 
 # Consts
 hostName = "127.0.0.1"
 serverPort = 8123
 
 SLEEP = 0.1
+KEEP_ALIVE = True       # HTTP/1.1 persistent connections
+IDLE_TIMEOUT = 5        # seconds before an idle keep-alive connection is closed
+
+SERVER_MODE = 'thread'  # 'thread': one thread per connection, 'pool': fixed worker pool (--mode)
+POOL_WORKERS = 64       # worker threads in 'pool' mode (--workers)
+POOL_QUEUE_SIZE = 256   # accepted connections waiting for a worker in 'pool' mode (--queue)
+ACCEPT_BACKLOG = 128    # listen() backlog of connections not yet accepted
+MAX_SAMPLES = 100000    # timing samples kept for the percentiles
+LOG_BUFFER_LINES = 100000   # log lines waiting for the writer thread
+LOG_FLUSH_LINES = 1000      # write to server.log once this many lines are waiting
+LOG_FLUSH_INTERVAL = 0.5    # or after this many seconds
+LOG_FULL = 'drop'           # buffer full: 'drop' the line or 'block' the request
 MAX_GENERATIONS = 6
+MAX_RECORDS_PAGE = 1000 # most records one /records call returns
 
 DATA_FOLDER = 'data/'
+CACHE_FOLDER = DATA_FOLDER + 'cache/'   # preparsed column files (city_store.py)
+
+# LatencyModel from the command line (latency.py), None: /record requests sleep SLEEP
+latency_model = None
+
+# live per-route numbers for /stats, reset by /start and /stats?reset=1
+metrics = RouteMetrics(('start', 'end', 'city', 'record', 'records'), prefix='noaa')
+
+# reply bodies, see responses.py
+CITY_REPLY = Template('city', 'records', status='OK')
+RECORD_REPLY = Template('city', 'date', 'temp', status='OK')
+RECORDS_REPLY = Template('city', 'start', 'count', 'records', status='OK')
+END_REPLY = Template('api', 'threads', 'total_time', 'calls_per_second', 'connections', 'mode', 'log_dropped',
+                     'queue_max', 'wait_avg', 'wait_p99', 'service_p50', 'service_p99', status='OK')
 
 # Global Variables
 max_thread_count = 0
 call_count = 0
 thread_count = 0
+connection_count = 0
 lock = threading.Lock()
 
 CITIES = (
@@ -68,7 +108,7 @@ CITIES = (
     ('phoenix' , 'phoenix.dat'),
 )
 
-# key = 'city name', value [[date, temp], ...]
+# key = 'city name', value city_store.CityColumns, mapped once (see load_cities())
 cities_data = {}
 
 start_time = time.time()
@@ -76,28 +116,206 @@ end_time = time.time()
 
 # ----------------------------------------------------------------------------
 class Log:
-
-    def __init__(self, filename):
+    """
+    Lines are added to a bounded buffer and a background thread writes them
+    to the file in batches, so a request never waits on the disk.  When the
+    buffer is full, LOG_FULL decides: 'drop' the line (counted in dropped)
+    or 'block' the request until the writer catches up.
+    """
+
+    def __init__(self, filename, buffer_lines=LOG_BUFFER_LINES, flush_lines=LOG_FLUSH_LINES,
+                 flush_interval=LOG_FLUSH_INTERVAL, full=LOG_FULL):
         super().__init__()
-        self.lock = threading.Lock()
         self.filename = filename
         self.file = open(filename, 'w')
+        self.buffer_lines = buffer_lines
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_interval
+        self.full = full
+        self.lines = collections.deque()
+        self.dropped = 0
+        self.closed = False
+        self.lock = threading.Condition()
+        self.file_lock = threading.Lock()   # keeps batches in order between the writer and flush()
+        self.writer = threading.Thread(target=self._writer, daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
 
     def write(self, line):
         with self.lock:
-            self.file.write(line)
-            self.file.write('\n')
-            self.file.flush()
-
-    def __del__(self):
+            if len(self.lines) >= self.buffer_lines:
+                if self.full != 'block':
+                    self.dropped += 1
+                    return
+                self.lock.wait_for(lambda: len(self.lines) < self.buffer_lines or self.closed)
+            self.lines.append(line)
+            if len(self.lines) >= self.flush_lines:
+                self.lock.notify_all()
+
+    def _write_batch(self):
+        with self.file_lock:
+            with self.lock:
+                batch = list(self.lines)
+                self.lines.clear()
+                self.lock.notify_all()      # wake requests blocked on a full buffer
+            if batch:
+                self.file.write('\n'.join(batch))
+                self.file.write('\n')
+                self.file.flush()
+
+    def _writer(self):
+        while not self.closed:
+            with self.lock:
+                self.lock.wait_for(lambda: len(self.lines) >= self.flush_lines or self.closed, self.flush_interval)
+            self._write_batch()
+
+    def flush(self):
+        """ Writes everything buffered so far before returning """
+        self._write_batch()
+
+    def close(self):
+        if self.closed:
+            return
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        self.writer.join()
+        self._write_batch()
         self.file.close()
 
 # Global log object
 log = Log('server.log')
 
+# ----------------------------------------------------------------------------
+class ServerStats:
+    """ Queue depth, queue wait and service times (seconds) since the last reset """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.max_queue_depth = 0
+            self.waits = []
+            self.wait_count = 0
+            self.wait_total = 0.0
+            self.services = []
+            self.service_count = 0
+
+    def _add_sample(self, samples, value, count):
+        # reservoir sampling keeps memory bounded on long runs
+        if len(samples) < MAX_SAMPLES:
+            samples.append(value)
+        else:
+            index = random.randrange(count)
+            if index < MAX_SAMPLES:
+                samples[index] = value
+
+    def add_queue_depth(self, depth):
+        with self.lock:
+            if depth > self.max_queue_depth:
+                self.max_queue_depth = depth
+
+    def add_wait(self, seconds):
+        with self.lock:
+            self.wait_count += 1
+            self.wait_total += seconds
+            self._add_sample(self.waits, seconds, self.wait_count)
+
+    def add_service(self, seconds):
+        with self.lock:
+            self.service_count += 1
+            self._add_sample(self.services, seconds, self.service_count)
+
+    def summary(self):
+        with self.lock:
+            waits = sorted(self.waits)
+            services = sorted(self.services)
+            max_queue_depth = self.max_queue_depth
+            wait_avg = self.wait_total / self.wait_count if self.wait_count else 0.0
+
+        def _percentile(samples, p):
+            if not samples:
+                return 0.0
+            return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+        return {
+            'queue_max': max_queue_depth,
+            'wait_avg': wait_avg,
+            'wait_p99': _percentile(waits, 0.99),
+            'service_p50': _percentile(services, 0.50),
+            'service_p99': _percentile(services, 0.99),
+        }
+
+# Global stats object
+stats = ServerStats()
+
+
+def load_cities():
+    # maps the preparsed column files, converting any .dat file that changed
+    global cities_data
+    if not cities_data:
+        def _log(s):
+            print(s)
+            log.write(s)
+        cities_data = city_store.load_cities(CITIES, DATA_FOLDER, CACHE_FOLDER, _log)
+
+
+def get_city_json(name):
+    return CITY_REPLY.render(name, len(cities_data[name]))
+
+
+def get_record_json(name, record):
+    date_str, temp = cities_data[name].record(record)
+    return RECORD_REPLY.render(name, date_str, temp)
+
+
+def get_records_json(name, first, count):
+    records = cities_data[name].records_json(first, count)
+    return RECORDS_REPLY.render(name, first, len(records), Raw(f'[{", ".join(records)}]'.encode('ascii')))
+
+
+def get_end_json(total_time, summary):
+    return END_REPLY.render(call_count, max_thread_count, total_time, call_count / total_time, connection_count,
+                            SERVER_MODE, log.dropped, summary['queue_max'], summary['wait_avg'],
+                            summary['wait_p99'], summary['service_p50'], summary['service_p99'])
+
+
+def delay_request(endpoint):
+    if latency_model is not None:
+        latency_model.wait(endpoint)
+    elif SLEEP > 0:
+        time.sleep(SLEEP)
+
 # ----------------------------------------------------------------------------
 class Handler(BaseHTTPRequestHandler):
 
+    # HTTP/1.1 keeps the connection open between requests as long as every
+    # reply has a Content-Length.  timeout closes idle connections.
+    protocol_version = 'HTTP/1.1' if KEEP_ALIVE else 'HTTP/1.0'
+    timeout = IDLE_TIMEOUT
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        global connection_count
+        super().setup()
+        with lock:
+            connection_count += 1
+
+    def send_reply(self, code, body=b'', content_type='application/json'):
+        self.reply_code = code
+        self.bytes_sent += len(body)
+        self.send_response(code)
+        self.send_header("Content-type",  content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if self.server.busy():
+            # free this worker for a connection waiting in the pool queue
+            self.send_header("Connection", "close")
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
     def get_city_details(self, name):
         # global people
         # if id in people:
@@ -116,11 +334,37 @@ class Handler(BaseHTTPRequestHandler):
         pass
 
    
+    def send_stats(self):
+        # not counted as an API call and never delayed
+        query = parse_qs(urlsplit(self.path).query)
+        if 'reset' in query:
+            metrics.reset()
+        if query.get('format', [''])[0] == 'prometheus':
+            self.send_reply(200, metrics.to_prometheus().encode('utf8'), 'text/plain; version=0.0.4')
+        else:
+            self.send_reply(200, metrics.to_json().encode('utf8'))
+
     def do_GET(self):
+        self.reply_code = None
+        self.bytes_sent = 0
+        if self.path.startswith('/stats'):
+            self.send_stats()
+            return
+
+        request = metrics.start(self.path)
+        start = time.perf_counter()
+        try:
+            self.handle_get()
+        finally:
+            stats.add_service(time.perf_counter() - start)
+            metrics.finish(request, self.reply_code, self.bytes_sent)
+
+    def handle_get(self):
         global thread_count
         global lock
         global max_thread_count
         global call_count
+        global connection_count
         global log
 
         with lock:
@@ -135,26 +379,29 @@ class Handler(BaseHTTPRequestHandler):
         print(s := f'Request: {self.path}')
         log.write(s)
 
+        # only /record waits by default, other endpoints when given their own model
+        # (/record and /records wait in their own branch, /records once per page)
+        endpoint = latency.endpoint_of(self.path)
+        if latency_model is not None and endpoint not in ('record', 'records') and endpoint in latency_model.endpoints:
+            latency_model.wait(endpoint)
+
         # START ---------------------------------------------------
         if 'start' in self.path:
             global start_time
-            global cities_data
 
-            # Load DAT files
-            cities_data = {}
-            for name, filename in CITIES:
-                print(s := f'Loading city data {name}')
-                log.write(s)
-                with open(DATA_FOLDER + filename, 'r') as f:
-                    cities_data[name] = json.load(f)
+            # the city data is mapped when the server starts, nothing to parse here
+            load_cities()
 
             max_thread_count = 1
             thread_count = 1
             call_count = 1
+            connection_count = 1
+            stats.reset()
+            metrics.reset()
 
             start_time = time.time()
 
-            json_data = '{"status":"OK"}'
+            json_data = OK
 
 
         # END ---------------------------------------------------
@@ -178,13 +425,26 @@ class Handler(BaseHTTPRequestHandler):
             print(s := f'Calls per second              : {call_count / (end_time - start_time)}')
             log.write(s)
 
-            data_str = '{' + \
-                       f'"status":"OK", "api": {call_count}, "threads": {max_thread_count}, "total_time": {end_time - start_time}, "calls_per_second": {call_count / (end_time - start_time)}' + \
-                       '}'
-            json_data = json.dumps(ast.literal_eval(data_str))
+            print(s := f'Connections (requests/conn)   : {connection_count} ({call_count / connection_count:.2f})')
+            log.write(s)
+
+            summary = stats.summary()
+            print(s := f'Server mode (pool workers)    : {SERVER_MODE} ({POOL_WORKERS if SERVER_MODE == "pool" else "-"})')
+            log.write(s)
+            print(s := f'Queue max depth               : {summary["queue_max"]}')
+            log.write(s)
+            print(s := f'Queue wait avg / p99          : {summary["wait_avg"]:.6f} / {summary["wait_p99"]:.6f}')
+            log.write(s)
+            print(s := f'Service time p50 / p99        : {summary["service_p50"]:.6f} / {summary["service_p99"]:.6f}')
+            log.write(s)
+            print(s := f'Log lines dropped             : {log.dropped}')
+            log.write(s)
+
+            json_data = get_end_json(end_time - start_time, summary)
 
             print('#' * 80)
             log.write('#' * 80)
+            log.flush()
 
         # CITY DETAILS  ---------------------------------------------------
         elif 'city' in self.path:
@@ -193,9 +453,7 @@ class Handler(BaseHTTPRequestHandler):
             # print(parts)
 
             if len(parts) != 3:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
+                self.send_reply(404)
                 with lock:
                     thread_count -= 1
                 return
@@ -206,40 +464,52 @@ class Handler(BaseHTTPRequestHandler):
                 name = None
 
             if name == None:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
+                self.send_reply(404)
                 with lock:
                     thread_count -= 1
                 return
 
             if name not in cities_data:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
+                self.send_reply(404)
+                with lock:
+                    thread_count -= 1
+                return
+
+            json_data = get_city_json(name)
+
+        # CITY RECORDS (range) -----------------------------------------
+        elif self.path.startswith('/records/'):
+
+            # one delay for the whole page
+            delay_request('records')
+
+            parts = self.path.split('/')
+            try:
+                name = parts[2].lower()
+                first = int(parts[3])
+                count = min(int(parts[4]), MAX_RECORDS_PAGE)
+            except:
+                name = None
+
+            if len(parts) != 5 or name not in cities_data or first < 0 or count < 1:
+                self.send_reply(404)
                 with lock:
                     thread_count -= 1
                 return
 
-            data_str = '{' + \
-                       f'"status":"OK", "city": "{name}", "records": {len(cities_data[name])}' + \
-                       '}'
-            json_data = json.dumps(ast.literal_eval(data_str))
+            json_data = get_records_json(name, first, count)
 
         # CITY RECORD  ---------------------------------------------------
         elif 'record' in self.path:
 
-            if SLEEP > 0:
-                time.sleep(SLEEP)
+            delay_request('record')
 
             parts = self.path.split('/')
             # print('****************************')
             # print(parts)
 
             if len(parts) != 4:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
+                self.send_reply(404)
                 with lock:
                     thread_count -= 1
                 return
@@ -252,61 +522,106 @@ class Handler(BaseHTTPRequestHandler):
                 record = None
 
             if name == None or record == None:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
+                self.send_reply(404)
                 with lock:
                     thread_count -= 1
                 return
 
             if name not in cities_data:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
+                self.send_reply(404)
                 with lock:
                     thread_count -= 1
                 return
 
-            date_str = cities_data[name][record][0]         # Format "mmdd hhmmss"
-            temp = cities_data[name][record][1]
-
-            # Expand date string to "mm-dd hh:mm:ss"
-            #         01234567890
-            # format "mmdd hhmmss"
-            date_str = date_str[:2] + '-' + date_str[2:4] + ' ' + date_str[5:7] + ':' + date_str[7:9] + ':' + date_str[9:]
-
-            data_str = '{' + \
-                       f'"status":"OK", "city": "{name}", "date": "{date_str}", "temp": {temp}' + \
-                       '}'
-            json_data = json.dumps(ast.literal_eval(data_str))
+            json_data = get_record_json(name, record)
 
         else:
             json_data = None
 
 
         if json_data == None:
-            self.send_response(404)
-            self.send_header("Content-type",  "application/json")
-            self.end_headers()
+            self.send_reply(404)
         else:
-            print('Sending:', json_data)
-            log.write(f'Sending: {json_data}')
+            # a /records page is long, only its start is shown
+            shown = json_data[:200].decode('utf8', 'replace') + ('...' if len(json_data) > 200 else '')
+            print('Sending:', shown)
+            log.write(f'Sending: {shown}')
 
-            self.send_response(200)
-            self.send_header("Content-type",  "application/json")
-            self.end_headers()
-            self.wfile.write(bytes(json_data, "utf8"))
+            self.send_reply(200, json_data)
 
         with lock:
             thread_count -= 1
 
 
 class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    pass
+    # keep-alive threads must not stop the server from exiting
+    daemon_threads = True
+    request_queue_size = ACCEPT_BACKLOG
+
+    def busy(self):
+        return False
+
+
+class PooledServer(HTTPServer):
+    """
+    Serves connections with a fixed number of worker threads.  Accepted
+    connections wait in a bounded queue; when it is full the accept loop
+    blocks and new clients wait in the listen() backlog.
+    """
+    request_queue_size = ACCEPT_BACKLOG
+
+    def __init__(self, server_address, handler_class, workers=POOL_WORKERS, queue_size=POOL_QUEUE_SIZE):
+        super().__init__(server_address, handler_class)
+        self.connections = queue.Queue(maxsize=queue_size)
+        self.workers = []
+        for _ in range(workers):
+            t = threading.Thread(target=self._worker, daemon=True)
+            t.start()
+            self.workers.append(t)
+
+    def busy(self):
+        return not self.connections.empty()
+
+    def process_request(self, request, client_address):
+        self.connections.put((request, client_address, time.perf_counter()))
+        stats.add_queue_depth(self.connections.qsize())
+
+    def _worker(self):
+        while True:
+            request, client_address, queued_time = self.connections.get()
+            stats.add_wait(time.perf_counter() - queued_time)
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
 
 
 if __name__ == '__main__':
-    server = ThreadingSimpleServer((hostName, serverPort), Handler)
+    parser = argparse.ArgumentParser(description='NOAA weather server')
+    parser.add_argument('--mode', choices=('thread', 'pool'), default=SERVER_MODE,
+                        help=f'one thread per connection or a fixed worker pool (default {SERVER_MODE})')
+    parser.add_argument('--workers', type=int, default=POOL_WORKERS,
+                        help=f'worker threads in pool mode (default {POOL_WORKERS})')
+    parser.add_argument('--queue', type=int, default=POOL_QUEUE_SIZE,
+                        help=f'accepted connections waiting for a worker in pool mode (default {POOL_QUEUE_SIZE})')
+    latency.add_arguments(parser, SLEEP)
+    args = parser.parse_args()
+    if args.workers < 1 or args.queue < 1:
+        parser.error('--workers and --queue must be at least 1')
+    SERVER_MODE, POOL_WORKERS, POOL_QUEUE_SIZE = args.mode, args.workers, args.queue
+    latency_model = latency.from_args(parser, args)
+    print(f'Latency: {latency_model} (for /record, other endpoints only with --endpoint)')
+    # capacity queue depth in /stats
+    metrics.add_gauges('latency', latency_model.metrics, latency_model.reset_metrics)
+    load_cities()
+
+    if SERVER_MODE == 'pool':
+        server = PooledServer((hostName, serverPort), Handler, POOL_WORKERS, POOL_QUEUE_SIZE)
+        print(f'Pool mode: {POOL_WORKERS} workers, queue of {POOL_QUEUE_SIZE} connections')
+    else:
+        server = ThreadingSimpleServer((hostName, serverPort), Handler)
     print(f'Starting server.  Waiting on {hostName}:{serverPort}, use <Ctrl-C> or <Command-C> to stop')
     server.serve_forever()
 
@@ -0,0 +1,65 @@
+"""
+Course: CSE 351
+Lesson Week: 10
+File: bench_memory.py
+Purpose: Assignment 10 - Family Search, server memory benchmark
+
+Instructions:
+
+Run "python bench_memory.py" in the folder with server.py.
+
+Builds the server's family tree for a range of generations with both
+TREE_STORAGE settings ('objects' and 'compact').  Every build runs in its own
+process so the peak RSS (resident memory) of one build doesn't hide the
+next.  "tree MB" is the peak RSS minus the RSS after importing server.py.
+"""
+
+import json
+import subprocess
+import sys
+import time
+
+GENERATIONS = (6, 8, 10, 12, 14)
+STORAGES = ('objects', 'compact')
+SEED = 351
+
+
+def peak_rss_mb():
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS reports bytes
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def measure(storage, generations):
+    """ Runs in the child process, prints one JSON line """
+    import server
+
+    before = peak_rss_mb()
+    server.TREE_STORAGE = storage
+    start = time.perf_counter()
+    server.build_tree(generations, SEED)
+    build_time = time.perf_counter() - start
+    after = peak_rss_mb()
+
+    print(json.dumps({'storage': storage, 'generations': generations,
+                      'people': server.get_people_count(), 'families': server.get_families_count(),
+                      'build_time': build_time, 'peak_rss_mb': after, 'tree_mb': after - before}))
+
+
+def main():
+    print(f'{"Storage":<10} {"Gens":>5} {"People":>10} {"Build (s)":>10} {"Peak RSS MB":>12} {"Tree MB":>10}')
+    for generations in GENERATIONS:
+        for storage in STORAGES:
+            output = subprocess.run([sys.executable, __file__, storage, str(generations)],
+                                    capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f'{storage:<10} {generations:>5} {result["people"]:>10,} {result["build_time"]:>10.3f} '
+                  f'{result["peak_rss_mb"]:>12.1f} {result["tree_mb"]:>10.1f}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3:
+        measure(sys.argv[1], int(sys.argv[2]))
+    else:
+        main()
@@ -0,0 +1,77 @@
+"""
+Course: CSE 351
+Lesson Week: 10
+File: bench_responses.py
+Purpose: Assignment 10 - Family Search, reply serialization benchmark
+
+Instructions:
+
+Run "python bench_responses.py" in the folder with server.py.
+The server doesn't need to be running.
+
+The server used to build its /end reply by formatting a Python literal
+string, parsing it with ast.literal_eval() and dumping it again with
+json.dumps(), and / with json.dumps() of a dict.  This times both replies
+the old way (rebuilt here) and with the Templates server.py and
+server_async.py use now, and checks that both give the same bytes.
+Person and family records are not here, server.py's CompactTree already
+built them as bytes.  The NOAA replies have their own bench_responses.py
+in lesson 4.  Times are per reply, the best of REPEATS runs.
+"""
+
+import ast
+import json
+import timeit
+
+from server import ROOT_REPLY, END_REPLY
+
+NUMBER = 20000
+REPEATS = 5             # best of
+
+START_ID = 6128784944
+END_VALUES = (2766, 1023, 3789, 64, 64, 0)     # people, families, api, threads, connections, log dropped
+
+
+def old_root():
+    return bytes(json.dumps({"start_family_id": START_ID}), 'utf8')
+
+
+def old_end():
+    people, families, calls, threads, connections, dropped = END_VALUES
+    data_str = '{' + \
+               f'"status":"OK", "people": {people}, "families": {families}, "api": {calls}, "threads": {threads}, "connections": {connections}, "log_dropped": {dropped}' + \
+               '}'
+    return bytes(json.dumps(ast.literal_eval(data_str)), 'utf8')
+
+
+def new_root():
+    return ROOT_REPLY.render(START_ID)
+
+
+def new_end():
+    return END_REPLY.render(*END_VALUES)
+
+
+REPLIES = (
+    # reply, old, new
+    ('/', old_root, new_root),
+    ('/end', old_end, new_end),
+)
+
+
+def best_time(function, number):
+    return min(timeit.repeat(function, number=number, repeat=REPEATS)) / number
+
+
+def main():
+    print(f'{"Reply":<10} {"Old (us)":>10} {"New (us)":>10} {"Speedup":>8}')
+    for reply, old, new in REPLIES:
+        if old() != new():
+            raise SystemExit(f'{reply}: the replies are not the same')
+        old_time = best_time(old, NUMBER)
+        new_time = best_time(new, NUMBER)
+        print(f'{reply:<10} {old_time * 1e6:>10.3f} {new_time * 1e6:>10.3f} {old_time / new_time:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
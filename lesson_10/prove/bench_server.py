@@ -0,0 +1,79 @@
+"""
+Course: CSE 351
+Lesson Week: 10
+File: bench_server.py
+Purpose: Assignment 10 - Family Search, request accounting microbenchmark
+
+Instructions:
+
+Run "python bench_server.py" in the folder with server.py.  You don't need
+to start the server, this program runs its own copy on a free port.
+
+With SLEEP = 0 every request is only the Handler's own work (counters,
+logging and sending a cached reply), so requests/sec shows how much the
+accounting and the console/log output cost as the number of concurrent
+clients grows.  Each client keeps one keep-alive connection open.
+"""
+
+import contextlib
+import http.client
+import io
+import threading
+import time
+
+import server
+
+CLIENTS = (1, 10, 100, 1000)
+REQUESTS = 10000        # total requests for each run
+GENERATIONS = 6
+
+
+def run_clients(port, clients, person_code):
+    requests_per_client = max(1, REQUESTS // clients)
+    barrier = threading.Barrier(clients + 1)
+
+    def _client():
+        conn = http.client.HTTPConnection(server.hostName, port, timeout=60)
+        barrier.wait()
+        for _ in range(requests_per_client):
+            conn.request('GET', f'/person/{person_code}')
+            conn.getresponse().read()
+        conn.close()
+
+    threads = [threading.Thread(target=_client) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    return clients * requests_per_client / (time.perf_counter() - start)
+
+
+def main():
+    server.SLEEP = 0
+    server.build_tree(GENERATIONS, 351)
+    person_code = server.encode(1)
+
+    # a listen() backlog big enough for every client to connect at once
+    server.ThreadingSimpleServer.request_queue_size = max(CLIENTS)
+    httpd = server.ThreadingSimpleServer((server.hostName, 0), server.Handler)
+    port = httpd.server_address[1]
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    print(f'{"Clients":>8} {"quiet req/s":>12} {"sampled req/s":>14} {"verbose req/s":>14}')
+    for clients in CLIENTS:
+        results = []
+        for verbose, sample in ((False, 1), (True, 100), (True, 1)):
+            server.VERBOSE = verbose
+            server.LOG_SAMPLE = sample
+            # keep the server's console output out of the results table
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                results.append(run_clients(port, clients, person_code))
+        print(f'{clients:>8} {results[0]:>12,.0f} {results[1]:>14,.0f} {results[2]:>14,.0f}')
+
+    httpd.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Course: CSE 351
+Lesson Week: 10
+File: bench_tree.py
+Purpose: Assignment 10 - Family Search, tree contention benchmark
+
+Instructions:
+
+Run "python bench_tree.py" in the folder with server.py and common.py.
+The server doesn't need to be running.
+
+Builds a 10 generation tree with server.py and then has 64 threads insert
+all of it into a client tree at the same time, the way the crawlers do:
+every thread tries every family and person and only the one that claims an
+id adds it.  Each thread starts at a different place in the list so they
+collide on different ids.  The time is the best of REPEATS runs.
+
+With the GIL only one thread runs Python code at a time, so the stripes
+can't beat one lock by much; the difference shows on a free-threaded build.
+
+  one lock        : Tree with seen sets guarded by a single lock (the old crawlers)
+  striped (1)     : ConcurrentTree with one stripe
+  striped (64)    : ConcurrentTree with TREE_STRIPES stripes
+"""
+
+import json
+import sys
+import threading
+import time
+
+import server
+from common import Tree, ConcurrentTree, Person, Family, TREE_STRIPES
+
+GENERATIONS = 10
+THREADS = 64
+REPEATS = 5             # best of
+SEED = 351
+
+
+class LockedTree(Tree):
+    """ The crawlers before ConcurrentTree: seen sets behind one lock """
+
+    def __init__(self, start_family_id):
+        super().__init__(start_family_id)
+        self.lock = threading.Lock()
+        self.seen_people = set()
+        self.seen_fam = set()
+
+    def claim_person(self, id):
+        with self.lock:
+            if id in self.seen_people:
+                return False
+            self.seen_people.add(id)
+            return True
+
+    def claim_family(self, id):
+        with self.lock:
+            if id in self.seen_fam:
+                return False
+            self.seen_fam.add(id)
+            return True
+
+
+def load_records():
+    server.build_tree(GENERATIONS, SEED)
+    people = {}
+    for id in range(1, server.get_people_count() + 1):
+        person = Person(json.loads(server.get_person_json(id)))
+        people[person.get_id()] = person
+    families = []
+    for id in range(1, server.get_families_count() + 1):
+        families.append(Family(json.loads(server.get_family_json(id))))
+    return people, families
+
+
+def run(tree, people, families):
+    barrier = threading.Barrier(THREADS + 1)
+
+    def _insert(offset):
+        barrier.wait()
+        count = len(families)
+        for i in range(count):
+            family = families[(offset + i) % count]
+            if not tree.claim_family(family.get_id()):
+                continue
+            tree.add_family(family)
+            for pid in [family.get_husband(), family.get_wife(), *family.get_children()]:
+                if pid is not None and tree.claim_person(pid):
+                    tree.add_person(people[pid])
+
+    step = max(1, len(families) // THREADS)
+    threads = [threading.Thread(target=_insert, args=(i * step,)) for i in range(THREADS)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+
+def main():
+    people, families = load_records()
+    start_id = families[0].get_id()
+    print(f'Python {sys.version.split()[0]}, GIL enabled: {getattr(sys, "_is_gil_enabled", lambda: True)()}')
+    print(f'{len(people):,} people, {len(families):,} families, {THREADS} threads\n')
+
+    print(f'{"Tree":<14} {"Time (s)":>10} {"Records/s":>12} {"People":>10} {"Families":>10}')
+    for name, make_tree in (('one lock', lambda: LockedTree(start_id)),
+                            ('striped (1)', lambda: ConcurrentTree(start_id, stripes=1)),
+                            (f'striped ({TREE_STRIPES})', lambda: ConcurrentTree(start_id))):
+        total_time = None
+        for _ in range(REPEATS):
+            tree = make_tree()
+            run_time = run(tree, people, families)
+            total_time = run_time if total_time is None else min(total_time, run_time)
+        records = tree.get_person_count() + tree.get_family_count()
+        print(f'{name:<14} {total_time:>10.4f} {records / total_time:>12,.0f} '
+              f'{tree.get_person_count():>10,} {tree.get_family_count():>10,}')
+
+
+if __name__ == '__main__':
+    main()
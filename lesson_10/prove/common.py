@@ -6,38 +6,624 @@ Author: <your name>
 Don't change this code.  You are not submitting it with your assignment
 
 """
+import os
 import time
+import json
+import hashlib
+import random
+import asyncio
+import threading
 import requests
+import requests.adapters
+from urllib.parse import urlsplit
 
 from cse351 import *
 
 TOP_API_URL = 'http://127.0.0.1:8123'
 
+BATCH_SIZE = 100    # must not be larger than MAX_BATCH_SIZE in server.py
+
 # ----------------------------------------------------------------------------
-def get_data_from_server(url):
-    retries = 50
-    delay = 0.01 # seconds
-    for i in range(retries):
+# Pooled HTTP session shared by every thread that calls get_data_from_server()
+#
+# One requests.Session keeps keep-alive connections in a pool per host, so
+# calls reuse sockets instead of opening (and leaving in TIME_WAIT) a new
+# connection for every record.
+
+POOL_SIZE = 100         # keep-alive connections kept per host
+POOL_BLOCK = False      # True: threads wait for a free connection instead of opening extra ones
+RETRIES = 50
+BACKOFF_BASE = 0.01     # seconds, largest delay for the first retry
+BACKOFF_MAX = 1.0       # seconds, largest delay for any retry
+MAX_LATENCY_SAMPLES = 10000
+
+TREE_STRIPES = 64       # locks in a ConcurrentTree, ids are spread over them
+
+# Adaptive limit on the requests in flight from get_data_from_server()
+LIMIT_MAX = None        # ceiling for the window (max requests in flight), None: no limit and no tuning
+LIMIT_MIN = 1
+LIMIT_START = 10        # starting window, doubles every round trip until the first slow/failed call
+LIMIT_DECREASE = 0.5    # window is multiplied by this on a slow or failed call
+LIMIT_SLOW = 2.0        # a call is slow when it takes LIMIT_SLOW times the fastest call seen
+LIMIT_SLOW_FLOOR = 0.05 # seconds, and at least this long (a fast server's jitter is not slow)
+
+# On-disk response cache, to run the crawlers without the server
+CACHE_MODE = None       # None: use the server, 'record': use the server and save every reply, 'replay': only saved replies
+CACHE_FOLDER = 'response_cache'
+REPLAY_LATENCY = 0.0    # seconds added to every replayed call (the server's SLEEP is 0.25)
+REPLAY_JITTER = 0.0     # plus a random 0 to REPLAY_JITTER seconds
+
+
+class LatencyStats:
+    """ Thread-safe call counters and latency samples (seconds) """
+
+    def __init__(self, max_samples=MAX_LATENCY_SAMPLES):
+        self.lock = threading.Lock()
+        self.max_samples = max_samples
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = 0
+            self.errors = 0
+            self.retries = 0
+            self.total_time = 0.0
+            self.max_time = 0.0
+            self.samples = []
+
+    def add_call(self, seconds, ok):
+        with self.lock:
+            self.calls += 1
+            if not ok:
+                self.errors += 1
+            self.total_time += seconds
+            if seconds > self.max_time:
+                self.max_time = seconds
+            # reservoir sampling keeps memory bounded on long runs
+            if len(self.samples) < self.max_samples:
+                self.samples.append(seconds)
+            else:
+                index = random.randrange(self.calls)
+                if index < self.max_samples:
+                    self.samples[index] = seconds
+
+    def add_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def summary(self):
+        with self.lock:
+            samples = sorted(self.samples)
+            calls = self.calls
+            result = {
+                'calls': calls,
+                'errors': self.errors,
+                'retries': self.retries,
+                'avg': self.total_time / calls if calls else 0.0,
+                'max': self.max_time,
+            }
+
+        def _percentile(p):
+            if not samples:
+                return 0.0
+            return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+        result['p50'] = _percentile(0.50)
+        result['p99'] = _percentile(0.99)
+        return result
+
+
+class PooledSession:
+    """ requests.Session with a bounded connection pool and retry backoff """
+
+    def __init__(self, pool_size=POOL_SIZE, pool_block=POOL_BLOCK):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=pool_size, pool_block=pool_block)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.stats = LatencyStats()
+
+    def backoff(self, attempt):
+        # exponential backoff with full jitter
+        self.stats.add_retry()
+        time.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)))
+
+    def get_json(self, url, retries=RETRIES, timeout=10):
+        start = time.perf_counter()
+        data = None
+        for i in range(retries):
+            try:
+                response = self.session.get(url, timeout=timeout)
+                response.raise_for_status()
+                if response.status_code == 200:
+                    data = response.json()
+                break
+
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if i < retries - 1:
+                    self.backoff(i)
+                else:
+                    print("Max retries reached. Failing.")
+
+            except requests.exceptions.RequestException as e:
+                break
+
+        self.stats.add_call(time.perf_counter() - start, data is not None)
+        return data
+
+    def get_stream(self, url, timeout=10):
+        """
+        Generator over an NDJSON reply, yields (kind, data) for every
+        {kind: data} line as it arrives and returns True at the end.  Raises
+        requests.exceptions.RequestException if the stream fails.
+        """
+        start = time.perf_counter()
+        ok = False
         try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            if response.status_code == 200:
-                return response.json()
-            break
-
-        except requests.exceptions.ConnectionError as e:
-            if i < retries - 1:
-                time.sleep(delay)
+            with self.session.get(url, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if line:
+                        record = json.loads(line)
+                        for kind, data in record.items():
+                            yield kind, data
+            ok = True
+            return True
+        finally:
+            self.stats.add_call(time.perf_counter() - start, ok)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = PooledSession()
+    return _session
+
+
+def configure_session(pool_size=POOL_SIZE, pool_block=POOL_BLOCK):
+    """ Replace the shared session, call before starting any threads """
+    global _session
+    with _session_lock:
+        _session = PooledSession(pool_size, pool_block)
+    return _session
+
+
+def get_session_stats():
+    return get_session().stats.summary()
+
+# ----------------------------------------------------------------------------
+class ConcurrencyLimiter:
+    """
+    Limits the number of requests in flight with a window tuned by AIMD,
+    like TCP congestion control.
+
+    Until the first slow or failed call the window grows by one for every
+    call that finishes (slow start, it doubles every round trip), after
+    that by 1/window (one per round trip).  A call that fails, or takes
+    LIMIT_SLOW times longer than the fastest call seen, multiplies the
+    window by LIMIT_DECREASE, at most once per round trip; a call is
+    never slow under slow_floor seconds.  The window stays between
+    min_limit and max_limit.
+
+    With max_limit None there is no window: calls are only counted until
+    a caller opts in with set_max_limit().
+    """
+
+    def __init__(self, max_limit=LIMIT_MAX, min_limit=LIMIT_MIN, start=LIMIT_START,
+                 decrease=LIMIT_DECREASE, slow=LIMIT_SLOW, slow_floor=LIMIT_SLOW_FLOOR):
+        self.lock = threading.Condition()
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.start = start
+        self.decrease = decrease
+        self.slow = slow
+        self.slow_floor = slow_floor
+        self.reset()
+
+    def reset(self):
+        """ Back to the starting window with no history """
+        with self.lock:
+            self.window = float(self._clamp(self.start))
+            self.slow_start = True
+            self.in_flight = 0
+            self.queued = 0
+            self.min_latency = None
+            self.last_decrease = 0
+            self.reset_metrics()
+            self.lock.notify_all()
+
+    def reset_metrics(self):
+        with self.lock:
+            self.max_in_flight = 0
+            self.max_queued = 0
+            self.calls = 0
+            self.decreases = 0
+
+    def _clamp(self, window):
+        if self.max_limit is not None:
+            window = min(window, self.max_limit)
+        return max(self.min_limit, window)
+
+    def set_max_limit(self, max_limit):
+        """ Change the ceiling (None: no limit), returns the old one """
+        with self.lock:
+            old = self.max_limit
+            self.max_limit = max_limit
+            self.window = self._clamp(self.window)
+            self.lock.notify_all()
+            return old
+
+    def acquire(self):
+        """ Waits for a place in the window, returns the start time for release() """
+        with self.lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+            self.lock.wait_for(lambda: self.max_limit is None or self.in_flight < int(self.window))
+            self.queued -= 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return time.perf_counter()
+
+    def release(self, start, ok=True, sample=True):
+        """
+        Ends a call started with acquire().  sample=False: its time says
+        nothing about the server (a streamed or replayed reply), only ok
+        counts.
+        """
+        now = time.perf_counter()
+        latency = now - start
+        with self.lock:
+            self.in_flight -= 1
+            self.calls += 1
+            if self.max_limit is None:
+                # no limit, nothing to tune
+                self.lock.notify_all()
+                return
+
+            if sample and ok and (self.min_latency is None or latency < self.min_latency):
+                self.min_latency = latency
+
+            slow = sample and latency > max(self.min_latency * self.slow, self.slow_floor)
+            if not ok or slow:
+                # the calls that started before the last decrease don't count again
+                if start > self.last_decrease:
+                    self.window = self._clamp(self.window * self.decrease)
+                    self.slow_start = False
+                    self.last_decrease = now
+                    self.decreases += 1
+            elif self.slow_start:
+                self.window = self._clamp(self.window + 1)
             else:
-                print("Max retries reached. Failing.")
-                
-        except requests.exceptions.Timeout:
-            ...
-            
-        except requests.exceptions.RequestException as e:
-            break
+                self.window = self._clamp(self.window + 1 / self.window)
+
+            self.lock.notify_all()
+
+    def metrics(self):
+        with self.lock:
+            return {'window': int(self.window), 'max_limit': self.max_limit,
+                    'in_flight': self.in_flight, 'queued': self.queued,
+                    'max_in_flight': self.max_in_flight, 'max_queued': self.max_queued,
+                    'calls': self.calls, 'decreases': self.decreases}
+
+
+_limiter = ConcurrencyLimiter()
+
+
+def get_limiter():
+    return _limiter
+
+# ----------------------------------------------------------------------------
+class ResponseCache:
+    """
+    Server replies saved on disk, one JSON file per request named by the
+    SHA-256 of the request.  A reply depends on the tree the server built,
+    so the last /start request is part of every name.
+
+    'record' mode asks the server and saves the reply, 'replay' mode only
+    reads saved replies (None if the request was never recorded) and waits
+    latency (+ up to jitter) seconds like the server would.  The replayed
+    /end reply has this run's API calls and max calls in flight.
+    """
+
+    def __init__(self, mode, folder=CACHE_FOLDER, latency=REPLAY_LATENCY, jitter=REPLAY_JITTER):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f'Unknown cache mode {mode!r}')
+        self.mode = mode
+        self.folder = folder
+        self.latency = latency
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.start_request = ''
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.misses = 0
+
+    def _filename(self, url):
+        parts = urlsplit(url)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        if target.startswith('/start'):
+            # like the server, the /start call is the first one counted
+            with self.lock:
+                self.start_request = target
+                self.calls = 1
+                self.max_in_flight = 1
+        key = hashlib.sha256(f'{self.start_request}\n{target}'.encode('utf8')).hexdigest()
+        return os.path.join(self.folder, key[:2], f'{key}.json'), target
+
+    def record(self, url, data):
+        filename, _ = self._filename(url)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # write then rename, so a reader never sees half a file
+        temp = f'{filename}.{threading.get_ident()}.tmp'
+        with open(temp, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp, filename)
+
+    def replay_start(self):
+        """ Counts a replayed call, returns how long it should take """
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return self.latency + (random.uniform(0, self.jitter) if self.jitter > 0 else 0)
+
+    def replay_end(self, url):
+        filename, target = self._filename(url)
+        # the call is in flight until its reply is read, like at the server
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            print(f'Not recorded: {target}')
+            return None
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+        if target.startswith('/end') and isinstance(data, dict):
+            data['api'] = self.calls
+            data['threads'] = self.max_in_flight
+        return data
+
+    def get_json(self, url):
+        if self.mode == 'record':
+            data = get_session().get_json(url)
+            self.record(url, data)
+            return data
+
+        delay = self.replay_start()
+        if delay > 0:
+            time.sleep(delay)
+        return self.replay_end(url)
+
+    def get_stream(self, url):
+        """ get_json() for an NDJSON reply, see PooledSession.get_stream() """
+        if self.mode == 'record':
+            records = []
+            for record in get_session().get_stream(url):
+                records.append(record)
+                yield record
+            # only a complete stream is saved
+            self.record(url, records)
+            return True
+
+        delay = self.replay_start()
+        if delay > 0:
+            time.sleep(delay)
+        records = self.replay_end(url)
+        if records is None:
+            return False
+        for kind, data in records:
+            yield kind, data
+        return True
+
+
+_response_cache = None
+
+
+def get_response_cache():
+    """ The ResponseCache for CACHE_MODE, or None to use the server """
+    global _response_cache
+    if _response_cache is None and CACHE_MODE is not None:
+        _response_cache = ResponseCache(CACHE_MODE)
+    return _response_cache
+
+
+def configure_cache(mode, folder=CACHE_FOLDER, latency=REPLAY_LATENCY, jitter=REPLAY_JITTER):
+    """ mode is 'record', 'replay' or None (use the server) """
+    global _response_cache
+    _response_cache = None if mode is None else ResponseCache(mode, folder, latency, jitter)
+    return _response_cache
+
+# ----------------------------------------------------------------------------
+def get_data_from_server(url):
+    limiter = get_limiter()
+    cache = get_response_cache()
+    start = limiter.acquire()
+    data = None
+    try:
+        if cache is None:
+            data = get_session().get_json(url)
+        else:
+            data = cache.get_json(url)
+    finally:
+        # a replayed call never reached the server, its time is no latency sample
+        replayed = cache is not None and cache.mode == 'replay'
+        limiter.release(start, data is not None, sample=not replayed)
+    return data
+
+# ----------------------------------------------------------------------------
+def get_batch_from_server(kind, ids):
+    """
+    Request many records with one API call per BATCH_SIZE ids.
+    kind is 'people' or 'families'.  Returns a list of dicts in the same
+    order as ids; an entry is None if the server didn't know that id.
+    """
+    ids = list(ids)
+    results = []
+    for start in range(0, len(ids), BATCH_SIZE):
+        chunk = ids[start:start + BATCH_SIZE]
+        codes = ','.join(str(id) for id in chunk)
+        data = get_data_from_server(f'{TOP_API_URL}/{kind}?ids={codes}')
+        if data is None:
+            results.extend([None] * len(chunk))
+        else:
+            results.extend(data)
+    return results
+
+
+def get_people_from_server(ids):
+    return get_batch_from_server('people', ids)
+
+
+def get_families_from_server(ids):
+    return get_batch_from_server('families', ids)
 
-    return None
+# ----------------------------------------------------------------------------
+def stream_subtree_from_server(family_id, depth):
+    """
+    Generator over the family family_id and its ancestors (depth generations)
+    streamed by the server as NDJSON.  Yields ('family', dict) and
+    ('person', dict) records as they arrive.  Like get_data_from_server() it
+    goes through the limiter and the response cache.
+    """
+    url = f'{TOP_API_URL}/subtree/{family_id}/{depth}'
+    limiter = get_limiter()
+    cache = get_response_cache()
+    start = limiter.acquire()
+    ok = False
+    try:
+        if cache is None:
+            ok = yield from get_session().get_stream(url)
+        else:
+            ok = yield from cache.get_stream(url)
+
+    except requests.exceptions.RequestException as e:
+        print(f'Subtree stream failed: {e}')
+
+    finally:
+        # the time of a stream depends on its size, it is no latency sample
+        limiter.release(start, ok, sample=False)
+
+
+def load_subtree_into_tree(tree, family_id, depth):
+    """ Adds the streamed records to tree as they arrive, returns the number added """
+    count = 0
+    for kind, data in stream_subtree_from_server(family_id, depth):
+        if kind == 'family':
+            if not tree.does_family_exist(data['id']):
+                tree.add_family(Family(data))
+                count += 1
+        elif kind == 'person':
+            if not tree.does_person_exist(data['id']):
+                tree.add_person(Person(data))
+                count += 1
+    return count
+
+# ----------------------------------------------------------------------------
+class AsyncSession:
+    """
+    HTTP/1.1 keep-alive GET client for asyncio code.  Open connections are
+    kept per host and reused; a bounded semaphore caps the number of
+    requests in flight (and so the number of connections) at pool_size.
+    Create it inside the running event loop.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE):
+        self.slots = asyncio.BoundedSemaphore(pool_size)
+        self.idle = {}      # (host, port) -> [(reader, writer), ...]
+        self.stats = LatencyStats()
+
+    async def _get(self, host, port, target):
+        connections = self.idle.setdefault((host, port), [])
+        if connections:
+            reader, writer = connections.pop()
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+
+        try:
+            writer.write(f'GET {target} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n'.encode('latin-1'))
+            await writer.drain()
+
+            status_line = await reader.readuntil(b'\r\n')
+            status = int(status_line.split()[1])
+            keep_alive = status_line.startswith(b'HTTP/1.1')
+            length = 0
+            while True:
+                line = await reader.readuntil(b'\r\n')
+                if line == b'\r\n':
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                name = name.strip().lower()
+                if name == 'content-length':
+                    length = int(value)
+                elif name == 'connection':
+                    keep_alive = value.strip().lower() != 'close'
+            body = await reader.readexactly(length)
+        except BaseException:
+            writer.close()
+            raise
+
+        if keep_alive:
+            connections.append((reader, writer))
+        else:
+            writer.close()
+
+        if status == 200 and body:
+            return json.loads(body)
+        return None
+
+    async def get_json(self, url, retries=RETRIES, timeout=10):
+        cache = get_response_cache()
+        if cache is not None and cache.mode == 'replay':
+            async with self.slots:
+                delay = cache.replay_start()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                return cache.replay_end(url)
+
+        parts = urlsplit(url)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+
+        start = time.perf_counter()
+        data = None
+        for i in range(retries):
+            try:
+                async with self.slots:
+                    data = await asyncio.wait_for(self._get(parts.hostname, parts.port or 80, target), timeout)
+                break
+
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+                # a pooled connection the server already closed ends up here too
+                if i < retries - 1:
+                    self.stats.add_retry()
+                    await asyncio.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** i)))
+                else:
+                    print("Max retries reached. Failing.")
+
+        self.stats.add_call(time.perf_counter() - start, data is not None)
+        if cache is not None:
+            cache.record(url, data)
+        return data
+
+    async def close(self):
+        for connections in self.idle.values():
+            for reader, writer in connections:
+                writer.close()
+        self.idle = {}
 
 # ----------------------------------------------------------------------------
 class Person:
@@ -154,118 +740,134 @@ class Tree:
         return id in self.__families
 
     def display(self, log):
-        log.write('\n\n')
-        log.write(f'{" TREE DISPLAY ":*^40}')
-        for family_id in self.__families:
-            fam = self.__families[family_id]
-
-            log.write(f'Family id: {family_id}')
-
-            # Husband
-            husband = self.get_person(fam.get_husband())
-            if husband == None:
-                log.write(f'  Husband: None')
-            else:
-                log.write(f'  Husband: {husband.get_name()}, {husband.get_birth()}')
-
-            # wife
-            wife = self.get_person(fam.get_wife())
-            if wife == None:
-                log.write(f'  Wife: None')
-            else:
-                log.write(f'  Wife: {wife.get_name()}, {wife.get_birth()}')
-
-            # Parents of Husband
-            if husband == None:
-                log.write(f'  Husband Parents: None')
-            else:
-                parent_fam_id = husband.get_parentid()
-                if parent_fam_id in self.__families:
-                    parent_fam = self.get_family(parent_fam_id)
-                    father = self.get_person(parent_fam.get_husband())
-                    mother = self.get_person(parent_fam.get_wife())
-                    log.write(f'  Husband Parents: {father.get_name()} and {mother.get_name()}')
-                else:
-                    log.write(f'  Husband Parents: None')
-
-            # Parents of Wife
-            if wife == None:
-                log.write(f'  Wife Parents: None')
-            else:
-                parent_fam_id = wife.get_parentid()
-                if parent_fam_id in self.__families:
-                    parent_fam = self.get_family(parent_fam_id)
-                    father = self.get_person(parent_fam.get_husband())
-                    mother = self.get_person(parent_fam.get_wife())
-                    log.write(f'  Wife Parents: {father.get_name()} and {mother.get_name()}')
-                else:
-                    log.write(f'  Wife Parents: None')
-
-            # children
-            output = []
-            for index, child_id in enumerate(fam.get_children()):
-                person = self.__people[child_id]
-                output.append(f'{person.get_name()}')
-            out_str = str(output).replace("'", '', 100)
-            log.write(f'  Children: {out_str[1:-1]}')
-
-        log.write('')
-        log.write(f'Number of people                    : {len(self.__people)}')
-        log.write(f'Number of families                  : {len(self.__families)}')
-        log.write(f'Max generations                     : {self._count_generations(self.__start_family_id)}')
-        log.write(f'People connected to starting family : {self._test_number_connected_to_start()}')
-
+        # the walk of _analyze() builds the lines of every family it reaches.
+        # Families it never reaches (not ancestors of the starting family) are
+        # still shown, so the loop below builds theirs and puts all of them in
+        # the order the families were added.  One write sends it all to the log.
+        family_lines = {}
+        generations, connected = self._analyze(family_lines=family_lines)
+        lines = ['\n', f'{" TREE DISPLAY ":*^40}']
+        for family_id, fam in self.__families.items():
+            lines.extend(family_lines.get(family_id) or self._family_lines(family_id, fam))
+        lines.append('')
+        lines.append(f'Number of people                    : {len(self.__people)}')
+        lines.append(f'Number of families                  : {len(self.__families)}')
+        lines.append(f'Max generations                     : {generations}')
+        lines.append(f'People connected to starting family : {connected}')
+        log.write('\n'.join(lines))
+
+    def _person_line(self, label, person):
+        if person == None:
+            return f'  {label}: None'
+        return f'  {label}: {person.get_name()}, {person.get_birth()}'
+
+    def _parents_line(self, label, person):
+        parent_fam = None if person == None else self.__families.get(person.get_parentid())
+        if parent_fam == None:
+            return f'  {label} Parents: None'
+        father = self.__people.get(parent_fam.get_husband())
+        mother = self.__people.get(parent_fam.get_wife())
+        father_name = father.get_name() if father != None else None
+        mother_name = mother.get_name() if mother != None else None
+        return f'  {label} Parents: {father_name} and {mother_name}'
+
+    def _family_lines(self, family_id, fam):
+        people = self.__people
+        husband = people.get(fam.get_husband())
+        wife = people.get(fam.get_wife())
+        children = ', '.join(people[child_id].get_name() for child_id in fam.get_children())
+        return [f'Family id: {family_id}',
+                self._person_line('Husband', husband),
+                self._person_line('Wife', wife),
+                self._parents_line('Husband', husband),
+                self._parents_line('Wife', wife),
+                f'  Children: {children}']
+
+    def _analyze(self, family_id=None, family_lines=None):
+        """
+        One walk up from family_id (default the starting family) without
+        recursion.  Returns (generations, people connected to that family).
+        When family_lines is a dict, the display lines of every family
+        reached are added to it (family id -> lines).
+        """
+        people = self.__people
+        families = self.__families
+        if family_id == None:
+            family_id = self.__start_family_id
+        if family_id not in families:
+            return 0, 0
+
+        # family id -> deepest generation it was reached at.  A family seen
+        # again deeper (shared ancestors) is walked again from there.
+        depth = {family_id: 0}
+        connected = set()
+        stack = [(family_id, 0)]
+        while stack:
+            id, gen = stack.pop()
+            if depth[id] > gen:
+                continue
+            fam = families[id]
+            if family_lines is not None and id not in family_lines:
+                family_lines[id] = self._family_lines(id, fam)
+            connected.update(fam.get_children())
+            for person_id in (fam.get_husband(), fam.get_wife()):
+                person = people.get(person_id)
+                if person == None:
+                    continue
+                connected.add(person_id)
+                parent_id = person.get_parentid()
+                if parent_id in families and depth.get(parent_id, -1) < gen + 1:
+                    depth[parent_id] = gen + 1
+                    stack.append((parent_id, gen + 1))
+
+        return max(depth.values()) + 1, len(connected)
 
     def _test_number_connected_to_start(self):
-        # start with first family, how many connected to that family
-        inds_seen = set()
-
-        def _recurive(family_id):
-            nonlocal inds_seen
-            if family_id in self.__families:
-                # count people in this family
-                fam = self.__families[family_id]
-
-                husband = self.get_person(fam.get_husband())
-                if husband != None:
-                    if husband.get_id() not in inds_seen:
-                        inds_seen.add(husband.get_id())
-                    _recurive(husband.get_parentid())
-                
-                wife = self.get_person(fam.get_wife())
-                if wife != None:
-                    if wife.get_id() not in inds_seen:
-                        inds_seen.add(wife.get_id())
-                    _recurive(wife.get_parentid())
-
-                for child_id in fam.get_children():
-                    if child_id not in inds_seen:
-                        inds_seen.add(child_id)
-
-
-        _recurive(self.__start_family_id)
-        return len(inds_seen)
-
+        return self._analyze()[1]
 
     def _count_generations(self, family_id):
-        max_gen = -1
+        return self._analyze(family_id)[0]
 
-        def _recurive_gen(id, gen):
-            nonlocal max_gen
-            if id in self.__families:
-                if max_gen < gen:
-                    max_gen = gen
 
-                fam = self.__families[id]
-
-                husband = self.get_person(fam.get_husband())
-                if husband != None:
-                    _recurive_gen(husband.get_parentid(), gen + 1)
-                
-                wife = self.get_person(fam.get_wife())
-                if wife != None:
-                    _recurive_gen(wife.get_parentid(), gen + 1)
+# -----------------------------------------------------------------------------
+class ConcurrentTree(Tree):
+    """
+    A Tree that many threads can fill at the same time.
+
+    Every id is guarded by one of TREE_STRIPES locks (id % stripes), so
+    threads working on different people/families rarely wait for each
+    other.  claim_person() and claim_family() are an atomic insert-if-absent:
+    only the first caller for an id gets True, which replaces the seen sets
+    a crawler keeps to avoid fetching the same record twice.
+    """
+
+    def __init__(self, start_family_id, stripes=TREE_STRIPES):
+        super().__init__(start_family_id)
+        self.__stripes = stripes
+        self.__locks = [threading.Lock() for _ in range(stripes)]
+        self.__claimed_people = set()
+        self.__claimed_families = set()
+
+    def claim_person(self, id):
+        """ True only for the first caller with this person id """
+        with self.__locks[hash(id) % self.__stripes]:
+            if id in self.__claimed_people:
+                return False
+            self.__claimed_people.add(id)
+            return True
+
+    def claim_family(self, id):
+        """ True only for the first caller with this family id """
+        with self.__locks[hash(id) % self.__stripes]:
+            if id in self.__claimed_families:
+                return False
+            self.__claimed_families.add(id)
+            return True
 
-        _recurive_gen(family_id, 0)
-        return max_gen + 1
+    def add_person(self, person):
+        with self.__locks[hash(person.get_id()) % self.__stripes]:
+            super().add_person(person)
 
+    def add_family(self, family):
+        with self.__locks[hash(family.get_id()) % self.__stripes]:
+            super().add_family(family)
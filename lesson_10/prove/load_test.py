@@ -0,0 +1,314 @@
+"""
+Course: CSE 351
+Lesson Week: 10
+File: load_test.py
+Purpose: Assignment 10 - Family Search, server load generator
+
+Instructions:
+
+Start server.py (or server_async.py) and run "python load_test.py" in
+another terminal.  "python load_test.py -h" lists the options.
+
+The test builds a tree with /start/<generations>?seed=<seed>, gets every
+family and person id with one /subtree request, then sends /person and
+/family requests for --duration seconds:
+
+  closed loop: --clients connections, each sends its next request when
+               the last reply arrives.
+  open loop  : requests are started at --rate per second (evenly spaced or
+               Poisson arrivals) no matter how fast replies come back, by up
+               to --clients connections.  Latency is measured from when a
+               request should have started, so time spent waiting for a
+               free connection counts.
+
+Latencies go into log-linear (HDR style) histograms: 2**SUB_BUCKET_BITS
+buckets for every power of two of microseconds, so every percentile is
+within 1/2**SUB_BUCKET_BITS of the real value.  The results, including
+the server's own /end reply, can be saved as JSON with --json to compare
+server modes.
+"""
+
+import argparse
+import http.client
+import json
+import queue
+import random
+import threading
+import time
+
+HOST = '127.0.0.1'
+PORT = 8123
+SUB_BUCKET_BITS = 6     # 64 buckets per power of two, ~1.6% resolution
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LatencyHistogram:
+    """ Counts of latencies in log-linear buckets of microseconds """
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def _bucket(micros):
+        # values below 2**SUB_BUCKET_BITS get a bucket each, above that the
+        # top SUB_BUCKET_BITS + 1 bits of the value pick the bucket
+        shift = max(0, micros.bit_length() - SUB_BUCKET_BITS - 1)
+        return shift, micros >> shift
+
+    def add(self, seconds):
+        key = self._bucket(int(seconds * 1_000_000))
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.total += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """ Upper edge of the bucket holding the percentile, in seconds """
+        if self.total == 0:
+            return 0.0
+        rank = max(1, round(self.total * percent / 100))
+        seen = 0
+        for shift, value in sorted(self.counts):
+            seen += self.counts[(shift, value)]
+            if seen >= rank:
+                return min(self.max, ((value + 1) << shift) / 1_000_000)
+        return self.max
+
+    def summary(self):
+        data = {'count': self.total,
+                'mean': self.sum / self.total if self.total else 0.0,
+                'max': self.max}
+        for percent in PERCENTILES:
+            data[f'p{percent:g}'] = self.percentile(percent)
+        return data
+
+
+# ----------------------------------------------------------------------------
+class Client:
+    """ One keep-alive connection, reconnects after an error """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.conn = None
+
+    def get(self, path):
+        """ Returns (status, body), status is None when the request failed """
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            self.conn.request('GET', path)
+            response = self.conn.getresponse()
+            body = response.read()
+            if response.getheader('Connection', '').lower() == 'close':
+                self.close()
+            return response.status, body
+        except (OSError, http.client.HTTPException):
+            self.close()
+            return None, b''
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class Worker:
+    """ Results of one connection, merged at the end """
+
+    def __init__(self, host, port):
+        self.client = Client(host, port)
+        self.latency = {'person': LatencyHistogram(), 'family': LatencyHistogram()}
+        self.errors = {'person': 0, 'family': 0}
+
+    def send(self, kind, path, start):
+        status, _ = self.client.get(path)
+        if status == 200:
+            self.latency[kind].add(time.perf_counter() - start)
+        else:
+            self.errors[kind] += 1
+
+
+def load_ids(host, port, generations, seed):
+    """ Builds the tree and returns (person paths, family paths) """
+    client = Client(host, port)
+    status, _ = client.get(f'/start/{generations}?seed={seed}')
+    status, body = client.get('/')
+    if status != 200:
+        raise SystemExit(f'No reply from the server at {host}:{port}')
+    start_id = json.loads(body)['start_family_id']
+
+    status, body = client.get(f'/subtree/{start_id}/{generations}')
+    client.close()
+    people = []
+    families = []
+    for line in body.splitlines():
+        if not line:
+            continue
+        for kind, data in json.loads(line).items():
+            if kind == 'person':
+                people.append(f'/person/{data["id"]}')
+            else:
+                families.append(f'/family/{data["id"]}')
+    return people, families
+
+
+def make_requests(people, families, person_share, rng):
+    """ Endless (kind, path) requests, person_share of them for people """
+    while True:
+        if rng.random() < person_share:
+            yield 'person', rng.choice(people)
+        else:
+            yield 'family', rng.choice(families)
+
+
+def run_closed(args, requests, workers):
+    lock = threading.Lock()
+    stop = time.perf_counter() + args.duration
+
+    def _run(worker):
+        while time.perf_counter() < stop:
+            with lock:
+                kind, path = next(requests)
+            worker.send(kind, path, time.perf_counter())
+
+    threads = [threading.Thread(target=_run, args=(worker,)) for worker in workers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def run_open(args, requests, workers, rng):
+    jobs = queue.Queue()
+
+    def _run(worker):
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            start, kind, path = job
+            worker.send(kind, path, start)
+
+    threads = [threading.Thread(target=_run, args=(worker,)) for worker in workers]
+    for t in threads:
+        t.start()
+
+    # each request has a start time on the schedule; a late request keeps
+    # its scheduled start so waiting for a connection shows in its latency
+    begin = time.perf_counter()
+    scheduled = begin
+    while scheduled < begin + args.duration:
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        kind, path = next(requests)
+        jobs.put((scheduled, kind, path))
+        if args.arrivals == 'poisson':
+            scheduled += rng.expovariate(args.rate)
+        else:
+            scheduled += 1 / args.rate
+
+    for _ in threads:
+        jobs.put(None)
+    for t in threads:
+        t.join()
+
+
+def print_results(results):
+    print(f'\n{results["model"]} loop, {results["clients"]} clients, {results["duration"]:.1f} s'
+          + (f', target {results["rate"]}/s' if results["rate"] else ''))
+    print(f'{"Request":<8} {"Count":>9} {"Errors":>7} {"Req/s":>9} {"Mean ms":>9} '
+          + ' '.join(f'{f"p{p:g} ms":>9}' for p in PERCENTILES) + f' {"Max ms":>9}')
+    for kind in ('person', 'family', 'all'):
+        data = results['latency'][kind]
+        print(f'{kind:<8} {data["count"]:>9,} {results["errors"][kind]:>7,} '
+              f'{data["count"] / results["duration"]:>9,.1f} {data["mean"] * 1000:>9.2f} '
+              + ' '.join(f'{data[f"p{p:g}"] * 1000:>9.2f}' for p in PERCENTILES)
+              + f' {data["max"] * 1000:>9.2f}')
+    server = results.get('server') or {}
+    print(f'Server: api calls {server.get("api")}, max threads {server.get("threads")}, '
+          f'connections {server.get("connections")}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for the Family Search server')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--model', choices=('closed', 'open'), default='closed')
+    parser.add_argument('--clients', type=int, default=10, help='connections (and threads)')
+    parser.add_argument('--rate', type=float, default=100.0, help='open loop: requests per second')
+    parser.add_argument('--arrivals', choices=('uniform', 'poisson'), default='uniform', help='open loop spacing')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds')
+    parser.add_argument('--generations', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=351, help='tree seed and request order')
+    parser.add_argument('--person-share', type=float, default=0.5, help='fraction of /person requests')
+    parser.add_argument('--label', default='', help='saved in the JSON, e.g. the server mode')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    people, families = load_ids(args.host, args.port, args.generations, args.seed)
+    print(f'{len(people):,} people, {len(families):,} families')
+
+    # /start again so the server's /end numbers only cover the test
+    Client(args.host, args.port).get(f'/start/{args.generations}?seed={args.seed}')
+    requests = make_requests(people, families, args.person_share, rng)
+    workers = [Worker(args.host, args.port) for _ in range(args.clients)]
+
+    start = time.perf_counter()
+    if args.model == 'closed':
+        run_closed(args, requests, workers)
+    else:
+        run_open(args, requests, workers, rng)
+    duration = time.perf_counter() - start
+
+    _, body = Client(args.host, args.port).get('/end')
+    for worker in workers:
+        worker.client.close()
+
+    latency = {kind: LatencyHistogram() for kind in ('person', 'family', 'all')}
+    errors = {'person': 0, 'family': 0}
+    for worker in workers:
+        for kind in ('person', 'family'):
+            latency[kind].merge(worker.latency[kind])
+            latency['all'].merge(worker.latency[kind])
+            errors[kind] += worker.errors[kind]
+    errors['all'] = errors['person'] + errors['family']
+
+    results = {
+        'label': args.label,
+        'model': args.model,
+        'clients': args.clients,
+        'rate': args.rate if args.model == 'open' else None,
+        'arrivals': args.arrivals if args.model == 'open' else None,
+        'duration': duration,
+        'generations': args.generations,
+        'seed': args.seed,
+        'throughput': latency['all'].total / duration,
+        'error_rate': errors['all'] / max(1, latency['all'].total + errors['all']),
+        'errors': errors,
+        'latency': {kind: histogram.summary() for kind, histogram in latency.items()},
+        'server': json.loads(body) if body else None,
+    }
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results saved to {args.json}')
+
+
+if __name__ == '__main__':
+    main()
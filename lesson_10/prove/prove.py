@@ -5,25 +5,51 @@ File: assignment.py
 Author: <your name>
 Purpose: Assignment 10 - Family Search
 """
+import sys
+
 from common import *
 from functions import depth_fs_pedigree, breadth_fs_pedigree, breadth_fs_pedigree_limit5
+from functions import depth_fs_pedigree_async, breadth_fs_pedigree_async, breadth_fs_pedigree_limit5_async
+from functions import depth_fs_pedigree_prefetch
 
 from cse351 import *
 
 DFS = 'Depth First Search'
 BFS = 'Breadth First Search'
 BFS5 = 'Breadth First Search limit 5'
+DFS_ASYNC = 'Depth First Search (asyncio)'
+BFS_ASYNC = 'Breadth First Search (asyncio)'
+BFS5_ASYNC = 'Breadth First Search limit 5 (asyncio)'
+DFS_PREFETCH = 'Depth First Search (prefetch parents)'
+
+# part number -> (title, function)
+PARTS = {
+    1: (DFS, depth_fs_pedigree),
+    2: (BFS, breadth_fs_pedigree),
+    3: (BFS5, breadth_fs_pedigree_limit5),
+    4: (DFS_ASYNC, depth_fs_pedigree_async),
+    5: (BFS_ASYNC, breadth_fs_pedigree_async),
+    6: (BFS5_ASYNC, breadth_fs_pedigree_limit5_async),
+    7: (DFS_PREFETCH, depth_fs_pedigree_prefetch),
+}
 
 def run_part(log, start_id, generations, title, func):
-    tree = Tree(start_id)
+    # the crawlers use the tree's claim_family/claim_person instead of seen sets
+    tree = ConcurrentTree(start_id)
 
     get_data_from_server(f'{TOP_API_URL}/start/{generations}')
+    # every part starts with no limit (a part may set one) and a fresh slow
+    # start, nothing carried over from the last part
+    limiter = get_limiter()
+    limiter.set_max_limit(LIMIT_MAX)
+    limiter.reset()
 
     log.write('\n')
     log.write('#' * 45)
     log.start_timer(f'{title}: {generations} generations')
     log.write('#' * 45)
-    func(start_id, tree)
+    # a part may return its critical path (round trips one after the other)
+    round_trips = func(start_id, tree)
     total_time = log.stop_timer()
 
     server_data = get_data_from_server(f'{TOP_API_URL}/end')
@@ -34,6 +60,9 @@ def run_part(log, start_id, generations, title, func):
     log.write('')
     log.write(f'total_time                    : {total_time:.5f}')
     log.write(f'Generations                   : {generations}')
+    if round_trips is not None:
+        log.write(f'Critical path (round trips)   : {round_trips}')
+        log.write(f'Time per round trip           : {total_time / max(1, round_trips):.5f}')
     log.write(f'People % Families / second    : {(tree.get_person_count()  + tree.get_family_count()) / total_time:.5f}')
     log.write('')
 
@@ -43,8 +72,35 @@ def run_part(log, start_id, generations, title, func):
     log.write(f'API Calls            : {server_data["api"]}')
     log.write(f'Max number of threads: {server_data["threads"]}')
 
+    limits = get_limiter().metrics()
+    if limits['max_limit'] is None:
+        log.write('Limiter window (max) : no limit at the end')
+    else:
+        log.write(f'Limiter window (max) : {limits["window"]} ({limits["max_limit"]})')
+    log.write(f'Max in flight/queued : {limits["max_in_flight"]} / {limits["max_queued"]}')
+    log.write(f'Window decreases     : {limits["decreases"]}')
+
+    return tree, total_time
+
+
+def display_benchmark(log, results):
+    # Side-by-side times of every part in runs.txt, threaded and asyncio
+    log.write('')
+    log.write(f'{" BENCHMARK ":*^70}')
+    log.write(f'{"Part":<42} {"Gens":>5} {"Time":>10} {"Records/s":>10}')
+    for title, generations, total_time, count in results:
+        log.write(f'{title:<42} {generations:>5} {total_time:>10.4f} {count / total_time:>10.2f}')
+
 
 def main():
+    # python prove.py record                  : use the server and save its replies
+    # python prove.py replay [latency] [jitter]: only use the saved replies
+    if len(sys.argv) > 1:
+        mode = sys.argv[1]
+        latency = float(sys.argv[2]) if len(sys.argv) > 2 else REPLAY_LATENCY
+        jitter = float(sys.argv[3]) if len(sys.argv) > 3 else REPLAY_JITTER
+        configure_cache(mode, latency=latency, jitter=jitter)
+
     log = Log(show_terminal=True, filename_log='assignment.log')
 
     # starting family
@@ -54,18 +110,23 @@ def main():
 
     # load runs.txt
     # part number, number of generations
+    results = []
     with open('runs.txt') as runs:
         for line in runs:
             parts = line.split(',')
             part_to_run = int(parts[0])
             generations = int(parts[1])
 
-            if part_to_run == 1:
-                run_part(log, start_id, generations, DFS, depth_fs_pedigree)
-            elif part_to_run == 2:
-                run_part(log, start_id, generations, BFS, breadth_fs_pedigree)
-            elif part_to_run == 3:
-                run_part(log, start_id, generations, BFS5, breadth_fs_pedigree_limit5)
+            if part_to_run in PARTS:
+                title, func = PARTS[part_to_run]
+                tree, total_time = run_part(log, start_id, generations, title, func)
+                results.append((title, generations, total_time, tree.get_person_count() + tree.get_family_count()))
+
+    display_benchmark(log, results)
+
+    cache = get_response_cache()
+    if cache is not None and cache.misses > 0:
+        log.write(f'Replies not recorded: {cache.misses} (record again with TREE_SEED set in server.py)')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,363 @@
+"""
+Course: CSE 351
+Lesson Week: 10
+File: server_async.py
+Author: Brother Comeau
+Purpose: Assignment 10 - Family Search, asyncio version of server.py
+
+Instructions:
+
+Open a terminal window and run this program instead of server.py
+
+This server answers the same API as server.py
+
+/start/<generations>
+/person/<id>
+/family/<id>
+/people?ids=<id>,<id>,...
+/families?ids=<id>,<id>,...
+/subtree/<id>/<depth>
+/end
+/stats (?format=prometheus, ?reset=1)
+
+The tree, the id encoding and the stats come from server.py.  The difference
+is that every request runs on one event loop and waits with asyncio.sleep()
+instead of holding an OS thread in time.sleep(), so a single process can keep
+tens of thousands of requests in flight when load testing a crawler.
+"threads" in the /end reply is the max number of requests in flight.
+"""
+
+import asyncio
+import argparse
+from urllib.parse import urlsplit, parse_qs
+
+import server
+import latency
+from route_stats import RouteMetrics
+from server import hostName, serverPort, encode, decode, decode_many, build_tree, log
+from server import get_person_json, get_family_json, get_batch_json, get_people_count, get_families_count
+from server import get_people_json, get_families_json
+from server import get_family_members, get_subtree_ndjson
+from server import ROOT_REPLY, END_REPLY
+from responses import OK
+
+SLEEP = server.SLEEP
+MAX_GENERATIONS = server.MAX_GENERATIONS
+MAX_BATCH_SIZE = server.MAX_BATCH_SIZE
+IDLE_TIMEOUT = server.IDLE_TIMEOUT
+ACCEPT_BACKLOG = 4096
+VERBOSE = False         # print/log every request like server.py (slow under load)
+
+# LatencyModel from the command line (latency.py), None: every request sleeps SLEEP
+latency_model = None
+
+# live per-route numbers for /stats, reset by /start and /stats?reset=1
+metrics = RouteMetrics(('root', 'start', 'end', 'person', 'family', 'people', 'families', 'subtree'),
+                       prefix='family_search')
+
+max_thread_count = 0
+call_count = 0
+thread_count = 0
+connection_count = 0
+
+family_request_order = []
+generations_created = 0
+
+REASONS = {200: 'OK', 404: 'Not Found'}
+
+
+def stats_reply(path):
+    """ (content type, body) for /stats, not counted as an API call """
+    query = parse_qs(urlsplit(path).query)
+    if 'reset' in query:
+        metrics.reset()
+    if query.get('format', [''])[0] == 'prometheus':
+        return 'text/plain; version=0.0.4', metrics.to_prometheus().encode('utf8')
+    return 'application/json', metrics.to_json().encode('utf8')
+
+
+def report(line):
+    print(line)
+    log.write(line)
+
+
+# ----------------------------------------------------------------------------
+def route(path):
+    """
+    Returns the JSON reply (bytes or str) for path, a list of NDJSON chunks
+    for /subtree or None for a 404
+    """
+    global max_thread_count
+    global thread_count
+    global call_count
+    global connection_count
+    global family_request_order
+    global generations_created
+
+    if 'start' in path:
+        family_request_order = []
+        url = urlsplit(path)
+        parts = url.path.split('/')
+        if len(parts) < 3:
+            return None
+
+        try:
+            generations = int(parts[-1])
+        except:
+            generations = MAX_GENERATIONS
+
+        try:
+            seed = int(parse_qs(url.query)['seed'][0])
+        except:
+            seed = server.TREE_SEED
+
+        report(f'Creating family tree with {generations} generations...')
+
+        generations_created = generations
+        build_tree(generations, seed)
+
+        max_thread_count = 1
+        thread_count = 1
+        call_count = 1
+        connection_count = 1
+        metrics.reset()
+
+        return OK
+
+    elif 'end' in path:
+        report('#' * 80)
+        report(f'Total number of people  : {get_people_count()}')
+        report(f'Total number of families: {get_families_count()}')
+        report(f'Number of generations   : {generations_created}')
+        report('Families were requested in this order:')
+        report(str(family_request_order)[1:-1])
+        report(f'Total number of API calls: {call_count}')
+        report(f'Final thread count (max count): {max_thread_count}')
+        report(f'Connections (requests/conn)   : {connection_count} ({call_count / connection_count:.2f})')
+        report(f'Log lines dropped             : {log.dropped}')
+        report('#' * 80)
+        log.flush()
+
+        return END_REPLY.render(get_people_count(), get_families_count(), call_count, max_thread_count,
+                                connection_count, log.dropped)
+
+    elif path.startswith('/subtree'):
+        parts = path.split('/')
+        try:
+            id = decode(int(parts[2]))
+            depth = int(parts[3])
+        except:
+            id = None
+
+        if id == None or get_family_members(id) is None:
+            return None
+
+        chunks = []
+        for family_id, chunk in get_subtree_ndjson(id, depth):
+            family_request_order.append(family_id)
+            chunks.append(chunk)
+        return chunks
+
+    elif path.startswith('/people') or path.startswith('/families'):
+        query = parse_qs(urlsplit(path).query)
+        try:
+            ids = decode_many([int(code) for code in query['ids'][0].split(',') if code != ''])
+        except:
+            ids = None
+
+        if not ids or len(ids) > MAX_BATCH_SIZE:
+            return None
+
+        if path.startswith('/people'):
+            return get_batch_json(get_people_json(ids))
+        else:
+            family_request_order.extend(ids)
+            return get_batch_json(get_families_json(ids))
+
+    elif 'person' in path or 'family' in path:
+        parts = path.split('/')
+        if len(parts) < 3:
+            return None
+
+        try:
+            id = decode(int(parts[-1]))
+        except:
+            id = None
+
+        if id == None:
+            return None
+
+        if 'person' in path:
+            return get_person_json(id)
+        else:
+            family_request_order.append(id)
+            return get_family_json(id)
+
+    else:
+        start_id = 1
+        return ROOT_REPLY.render(encode(start_id))
+
+
+async def handle_request(path):
+    global max_thread_count
+    global thread_count
+    global call_count
+
+    # Only one thread touches these counters, no lock needed
+    thread_count += 1
+    call_count += 1
+    if thread_count > max_thread_count:
+        max_thread_count = thread_count
+
+    if VERBOSE:
+        report(f'Current: active requests / max count: {thread_count} / {max_thread_count}')
+        report(f'Request: {path}')
+
+    try:
+        if latency_model is not None:
+            await latency_model.wait_async(latency.endpoint_of(path))
+        elif SLEEP > 0:
+            await asyncio.sleep(SLEEP)
+
+        json_data = route(path)
+    finally:
+        thread_count -= 1
+
+    if json_data == None:
+        return 404, b''
+
+    if isinstance(json_data, list):
+        return 200, json_data
+    if VERBOSE:
+        report(f'Sending: {json_data.decode("utf8")}')
+    return 200, json_data
+
+
+# ----------------------------------------------------------------------------
+async def read_request(reader):
+    """ Returns (path, keep_alive) or None when the client is done """
+    request_line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+    parts = request_line.split()
+    if len(parts) < 3:
+        return None
+
+    keep_alive = parts[2] == b'HTTP/1.1'
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'connection':
+            value = value.strip().lower()
+            if value == 'close':
+                keep_alive = False
+            elif value == 'keep-alive':
+                keep_alive = True
+
+    return parts[1].decode('latin-1'), keep_alive
+
+
+async def handle_connection(reader, writer):
+    global connection_count
+    connection_count += 1
+
+    try:
+        while True:
+            request = await read_request(reader)
+            if request is None:
+                break
+            path, keep_alive = request
+
+            if path.startswith('/stats'):
+                content_type, body = stats_reply(path)
+                await send_reply(writer, 200, body, keep_alive, content_type)
+                if not keep_alive:
+                    break
+                continue
+
+            stats_request = metrics.start(path)
+            code = None
+            bytes_sent = 0
+            try:
+                code, body = await handle_request(path)
+                bytes_sent = await send_reply(writer, code, body, keep_alive)
+            finally:
+                metrics.finish(stats_request, code, bytes_sent)
+
+            if not keep_alive:
+                break
+
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+
+    finally:
+        writer.close()
+
+
+async def send_reply(writer, code, body, keep_alive, content_type='application/json'):
+    """ Writes the reply, returns the body bytes sent """
+    connection = "keep-alive" if keep_alive else "close"
+    if isinstance(body, list):
+        # /subtree: NDJSON sent with chunked transfer
+        header = f'HTTP/1.1 {code} {REASONS[code]}\r\n' \
+                 f'Content-type: application/x-ndjson\r\n' \
+                 f'Transfer-Encoding: chunked\r\n' \
+                 f'Connection: {connection}\r\n\r\n'
+        writer.write(header.encode('latin-1'))
+        for chunk in body:
+            writer.write(b'%x\r\n%b\r\n' % (len(chunk), chunk))
+            await writer.drain()
+        writer.write(b'0\r\n\r\n')
+        bytes_sent = sum(len(chunk) for chunk in body)
+    else:
+        header = f'HTTP/1.1 {code} {REASONS[code]}\r\n' \
+                 f'Content-type: {content_type}\r\n' \
+                 f'Content-Length: {len(body)}\r\n' \
+                 f'Connection: {connection}\r\n\r\n'
+        writer.write(header.encode('latin-1') + body)
+        bytes_sent = len(body)
+    await writer.drain()
+    return bytes_sent
+
+
+def raise_open_file_limit():
+    # Each connection is a file descriptor; the default soft limit is often 1024
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = 65536 if hard == resource.RLIM_INFINITY else hard
+    if soft < target:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        except (ValueError, OSError):
+            pass
+
+
+async def main():
+    raise_open_file_limit()
+    async_server = await asyncio.start_server(handle_connection, hostName, serverPort, backlog=ACCEPT_BACKLOG)
+    print('Starting asyncio Family Search server, use <Ctrl-C> or <Command-C> to stop')
+    print(f'URL = {hostName}:{serverPort}\n')
+    async with async_server:
+        await async_server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='asyncio Family Search server')
+    parser.add_argument('--seed', type=int, default=server.TREE_SEED,
+                        help='same ids, tree shape, names and dates on every run')
+    latency.add_arguments(parser, SLEEP)
+    args = parser.parse_args()
+    if args.seed is not None:
+        server.set_seed(args.seed)
+    latency_model = latency.from_args(parser, args)
+    print(f'Latency: {latency_model}')
+    # capacity queue depth in /stats
+    metrics.add_gauges('latency', latency_model.metrics, latency_model.reset_metrics)
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
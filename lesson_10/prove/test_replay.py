@@ -0,0 +1,96 @@
+"""
+Course: CSE 351
+Lesson Week: 10
+File: test_replay.py
+Purpose: Assignment 10 - Family Search, replayed crawls keep their concurrency
+
+Instructions:
+
+Run "python -m pytest test_replay.py" (or "python test_replay.py") in the
+folder with common.py.  The server doesn't need to be running.
+
+A small pedigree is recorded into a temporary ResponseCache folder, then
+breadth_fs_pedigree replays it with the ConcurrencyLimiter turned on.
+Replayed calls never reach the server, so their times must not shrink the
+window: the crawl has to keep more than one request in flight.
+"""
+
+import tempfile
+
+from common import *
+from functions import breadth_fs_pedigree
+
+GENERATIONS = 5
+CHILDREN = 3            # children of a family besides the one married in the next family down
+REPLAY_LATENCY = 0.06   # seconds, plus up to REPLAY_JITTER: many calls take over LIMIT_SLOW times the fastest
+REPLAY_JITTER = 0.1
+WINDOW = 100
+
+
+def husband_id(family_id):
+    return 1000 + 2 * family_id
+
+
+def wife_id(family_id):
+    return 1000 + 2 * family_id + 1
+
+
+def build_pedigree(generations):
+    """
+    {url: reply} of a full pedigree.  Family 1 is the start, the parents of
+    family f are families 2f (husband's) and 2f + 1 (wife's).
+    """
+    last_family = 2 ** generations - 1
+    replies = {}
+    for fid in range(1, last_family + 1):
+        children = [5000 + CHILDREN * fid + k for k in range(CHILDREN)]
+        if fid > 1:
+            # the husband or wife of the family below is a child of this one
+            children.append(husband_id(fid // 2) if fid % 2 == 0 else wife_id(fid // 2))
+        replies[f'{TOP_API_URL}/family/{fid}'] = {'id': fid, 'husband_id': husband_id(fid),
+                                                  'wife_id': wife_id(fid), 'children': children}
+
+        for pid, parents in ((husband_id(fid), 2 * fid), (wife_id(fid), 2 * fid + 1)):
+            replies[f'{TOP_API_URL}/person/{pid}'] = {
+                'id': pid, 'name': f'Person {pid}', 'birth': '1-1-1900',
+                'parent_id': parents if parents <= last_family else None, 'family_id': fid}
+        for pid in children[:CHILDREN]:
+            replies[f'{TOP_API_URL}/person/{pid}'] = {
+                'id': pid, 'name': f'Person {pid}', 'birth': '1-1-1900', 'parent_id': fid, 'family_id': None}
+    return replies
+
+
+def test_replayed_bfs_keeps_requests_in_flight():
+    replies = build_pedigree(GENERATIONS)
+    start_url = f'{TOP_API_URL}/start/{GENERATIONS}'
+    limiter = get_limiter()
+    old_max = limiter.set_max_limit(WINDOW)
+    with tempfile.TemporaryDirectory() as folder:
+        recorder = ResponseCache('record', folder)
+        recorder.record(start_url, {'status': 'OK'})
+        for url, data in replies.items():
+            recorder.record(url, data)
+
+        try:
+            cache = configure_cache('replay', folder, REPLAY_LATENCY, REPLAY_JITTER)
+            get_data_from_server(start_url)
+            limiter.reset()
+            tree = ConcurrentTree(1)
+            breadth_fs_pedigree(1, tree)
+            limits = limiter.metrics()
+        finally:
+            configure_cache(None)
+            limiter.set_max_limit(old_max)
+            limiter.reset()
+
+    assert cache.misses == 0
+    assert tree.get_family_count() == 2 ** GENERATIONS - 1
+    assert limits['decreases'] == 0
+    assert limits['window'] > LIMIT_START
+    assert limits['max_in_flight'] > 1
+    assert cache.max_in_flight > 1
+
+
+if __name__ == '__main__':
+    test_replayed_bfs_keeps_requests_in_flight()
+    print('OK')
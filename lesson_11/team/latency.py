@@ -0,0 +1,189 @@
+"""
+Course: CSE 351
+File: latency.py
+Purpose: Latency models for the class servers
+
+Instead of sleeping a fixed time for every request, a server can use a
+LatencyModel:
+
+  constant:<seconds>                          every request takes seconds
+  lognormal:<median>[:<sigma>]                most near median, a long slow tail
+  bimodal:<seconds>[:<chance>[:<factor>]]     seconds, but chance of the requests
+                                              (a tail spike) take factor times longer
+
+Any endpoint (the first part of the path: person, family, city, record,
+people, ...) can have its own model, and capacity > 0 lets only that many
+requests be served at the same time; the rest wait in line for a place,
+like a backend that is saturated.  metrics() has how many wait now and the
+most that waited, the servers with /stats report it there.
+
+The servers take these on the command line:
+
+  python server.py --latency lognormal:0.25:0.8 --endpoint family=bimodal:0.25:0.05:10 --capacity 20
+
+lesson_10/prove/latency.py is the master copy.  Every lesson folder runs on
+its own, so lesson_02/team, lesson_03/team, lesson_04/prove, lesson_11/team
+and lesson_14/prove have the same file: change the master, then copy it over
+the others.
+"""
+
+import asyncio
+import math
+import random
+import threading
+import time
+
+KINDS = ('constant', 'lognormal', 'bimodal')
+
+
+class Distribution:
+    """ One latency distribution, sample() returns seconds """
+
+    def __init__(self, kind='constant', seconds=0.0, sigma=0.5, chance=0.01, factor=10.0):
+        if kind not in KINDS:
+            raise ValueError(f'Unknown latency model {kind!r}, use one of {", ".join(KINDS)}')
+        self.kind = kind
+        self.seconds = seconds
+        self.sigma = sigma
+        self.chance = chance
+        self.factor = factor
+
+    def sample(self, rng):
+        if self.seconds <= 0:
+            return 0.0
+        if self.kind == 'lognormal':
+            return rng.lognormvariate(math.log(self.seconds), self.sigma)
+        if self.kind == 'bimodal' and rng.random() < self.chance:
+            return self.seconds * self.factor
+        return self.seconds
+
+    def __str__(self):
+        if self.kind == 'lognormal':
+            return f'lognormal median {self.seconds} sigma {self.sigma}'
+        if self.kind == 'bimodal':
+            return f'bimodal {self.seconds}, {self.chance:.1%} at x{self.factor}'
+        return f'constant {self.seconds}'
+
+
+def parse_distribution(spec):
+    """ 'kind:seconds[:...]' (or just seconds) -> Distribution """
+    parts = spec.split(':')
+    try:
+        if len(parts) == 1:
+            return Distribution('constant', float(parts[0]))
+        kind = parts[0]
+        numbers = [float(part) for part in parts[1:]]
+        if kind == 'lognormal':
+            return Distribution(kind, *numbers[:1], sigma=numbers[1] if len(numbers) > 1 else 0.5)
+        if kind == 'bimodal':
+            return Distribution(kind, *numbers[:1], chance=numbers[1] if len(numbers) > 1 else 0.01,
+                                factor=numbers[2] if len(numbers) > 2 else 10.0)
+        return Distribution(kind, *numbers[:1])
+    except (ValueError, TypeError) as e:
+        raise ValueError(f'Bad latency model {spec!r}: {e}')
+
+
+class LatencyModel:
+    """
+    The delay for every request: a default distribution, optional
+    per-endpoint distributions and an optional service capacity.
+    """
+
+    def __init__(self, default, endpoints=None, capacity=0, seed=None):
+        self.default = default
+        self.endpoints = endpoints or {}
+        self.capacity = capacity
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(capacity) if capacity > 0 else None
+        self.async_slots = None
+        self.waiting = 0
+        self.max_waiting = 0
+
+    def delay(self, endpoint):
+        distribution = self.endpoints.get(endpoint, self.default)
+        with self.lock:
+            return distribution.sample(self.rng)
+
+    def _wait_for_slot(self, change):
+        with self.lock:
+            self.waiting += change
+            self.max_waiting = max(self.max_waiting, self.waiting)
+
+    def wait(self, endpoint):
+        """ Blocks the calling thread for the request's latency """
+        seconds = self.delay(endpoint)
+        if self.slots is None:
+            if seconds > 0:
+                time.sleep(seconds)
+            return
+
+        self._wait_for_slot(1)
+        with self.slots:
+            self._wait_for_slot(-1)
+            if seconds > 0:
+                time.sleep(seconds)
+
+    async def wait_async(self, endpoint):
+        """ wait() for asyncio servers """
+        seconds = self.delay(endpoint)
+        if self.capacity <= 0:
+            if seconds > 0:
+                await asyncio.sleep(seconds)
+            return
+
+        if self.async_slots is None:
+            self.async_slots = asyncio.Semaphore(self.capacity)
+        self._wait_for_slot(1)
+        async with self.async_slots:
+            self._wait_for_slot(-1)
+            if seconds > 0:
+                await asyncio.sleep(seconds)
+
+    def metrics(self):
+        """ Requests waiting for a capacity place now, and the most since reset_metrics() """
+        with self.lock:
+            return {'capacity': self.capacity, 'waiting': self.waiting, 'max_waiting': self.max_waiting}
+
+    def reset_metrics(self):
+        with self.lock:
+            self.max_waiting = self.waiting
+
+    def __str__(self):
+        text = str(self.default)
+        for endpoint, distribution in self.endpoints.items():
+            text += f', {endpoint}: {distribution}'
+        if self.capacity > 0:
+            text += f', capacity {self.capacity}'
+        return text
+
+
+def endpoint_of(path):
+    """ '/family/123' -> 'family', '/people?ids=1,2' -> 'people', '/' -> '' """
+    return path.lstrip('/').split('/', 1)[0].split('?', 1)[0]
+
+
+def add_arguments(parser, seconds):
+    """ Adds the latency options to an argparse parser, seconds is the default delay """
+    parser.add_argument('--latency', default=str(seconds),
+                        help=f'default model: constant:S, lognormal:MEDIAN[:SIGMA], '
+                             f'bimodal:S[:CHANCE[:FACTOR]] (default {seconds})')
+    parser.add_argument('--endpoint', action='append', default=[], metavar='NAME=MODEL',
+                        help='model for one endpoint, e.g. family=lognormal:0.3 (repeat for more)')
+    parser.add_argument('--capacity', type=int, default=0,
+                        help='requests served at the same time, the rest wait (0: no limit)')
+    parser.add_argument('--latency-seed', type=int, default=None, help='seed for the random delays')
+
+
+def from_args(parser, args):
+    """ LatencyModel from the add_arguments() options, a bad option exits with parser.error() """
+    try:
+        endpoints = {}
+        for option in args.endpoint:
+            name, _, spec = option.partition('=')
+            if not spec:
+                raise ValueError(f'Use NAME=MODEL for --endpoint, not {option!r}')
+            endpoints[name] = parse_distribution(spec)
+        return LatencyModel(parse_distribution(args.latency), endpoints, args.capacity, args.latency_seed)
+    except ValueError as e:
+        parser.error(str(e))
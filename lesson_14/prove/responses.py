@@ -0,0 +1,73 @@
+"""
+Course: CSE 351
+File: responses.py
+Purpose: Fast JSON reply bodies for the class servers
+
+Most replies are JSON objects with the same keys every time, only the
+values change.  A Template encodes everything but the values once, so
+rendering a reply is a join of bytes:
+
+  CITY = Template('city', 'records', status='OK')
+  CITY.render('dallas', 10000)
+      -> b'{"status": "OK", "city": "dallas", "records": 10000}'
+
+The fixed keys (status='OK') come first.  The bytes are the same as
+json.dumps() of the same dict.  A value that is already JSON (like a list
+of encoded records) is passed as Raw(bytes) and copied as is.
+
+This file is also in lesson_04/prove and lesson_14/prove.  The one in
+lesson_10/prove is the master, copy it over those two after a change.
+"""
+
+import json
+import math
+from json.encoder import encode_basestring_ascii
+
+OK = b'{"status": "OK"}'
+
+
+class Raw(bytes):
+    """ A value that is already encoded JSON """
+
+
+def value_json(value):
+    """ One JSON value as bytes, the same as json.dumps(value) """
+    if isinstance(value, Raw):
+        return value
+    if isinstance(value, str):
+        return encode_basestring_ascii(value).encode('ascii')
+    if value is None:
+        return b'null'
+    if value is True:
+        return b'true'
+    if value is False:
+        return b'false'
+    if isinstance(value, int):
+        return b'%d' % value
+    if isinstance(value, float) and math.isfinite(value):
+        return repr(value).encode('ascii')
+    return json.dumps(value).encode('utf8')
+
+
+class Template:
+    """ A JSON object with fixed keys, the fixed part encoded once """
+
+    def __init__(self, *keys, **fixed):
+        self.keys = keys
+        start = json.dumps(fixed)[:-1] if fixed else '{'
+        # parts[i] goes before value i, parts[-1] closes the object
+        self.parts = []
+        for i, key in enumerate(keys):
+            before = start + (', ' if fixed else '') if i == 0 else ', '
+            self.parts.append(f'{before}{json.dumps(key)}: '.encode('utf8'))
+        self.parts.append(b'}' if keys else (start + '}').encode('utf8'))
+
+    def render(self, *values):
+        if len(values) != len(self.keys):
+            raise TypeError(f'Template takes {len(self.keys)} values, not {len(values)}')
+        body = []
+        for part, value in zip(self.parts, values):
+            body.append(part)
+            body.append(value_json(value))
+        body.append(self.parts[-1])
+        return b''.join(body)
@@ -0,0 +1,164 @@
+"""
+Course: CSE 351
+File: route_stats.py
+Purpose: Live per-route request metrics for the class servers
+
+A server makes one RouteMetrics with the names of its routes and calls
+start()/finish() around every request.  For every route it keeps:
+
+  requests, errors (reply code not 200), in flight now, max in flight,
+  bytes sent and a latency histogram with fixed buckets (BUCKETS)
+
+A snapshot is a fixed number of routes times a fixed number of buckets, so
+building one costs the same no matter how many requests were served.  The
+servers reply to /stats with to_json(), /stats?format=prometheus with
+to_prometheus() and /stats?reset=1 clears the counters.
+
+add_gauges() adds numbers kept somewhere else, like the capacity queue of
+the latency model, to every snapshot.
+
+Edit lesson_10/prove/route_stats.py only; lesson_04/prove and lesson_14/prove
+have copies of it that must stay the same.
+"""
+
+import json
+import threading
+import time
+
+# upper bounds (seconds) of the latency buckets, the last bucket is everything slower
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+OTHER = 'other'
+
+
+class RouteStats:
+    """ Counters of one route, changed under RouteMetrics' lock for the route """
+
+    __slots__ = ('lock', 'requests', 'errors', 'in_flight', 'max_in_flight', 'bytes_sent',
+                 'seconds', 'buckets')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.bytes_sent = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def snapshot(self):
+        with self.lock:
+            return {'requests': self.requests, 'errors': self.errors, 'in_flight': self.in_flight,
+                    'max_in_flight': self.max_in_flight, 'bytes_sent': self.bytes_sent,
+                    'seconds': self.seconds, 'buckets': list(self.buckets)}
+
+
+class RouteMetrics:
+
+    def __init__(self, routes, prefix='server'):
+        # the routes are fixed up front, any other path is counted as OTHER
+        self.routes = {name: RouteStats() for name in (*routes, OTHER)}
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.started = time.time()
+        self.gauges = {}
+
+    def add_gauges(self, name, snapshot, reset=None):
+        """ snapshot() -> {key: number} is in every snapshot under name, reset() is called by reset() """
+        self.gauges[name] = (snapshot, reset)
+
+    def route_of(self, path):
+        """ '/family/123' -> 'family', '/people?ids=1' -> 'people', '/' -> 'root' """
+        name = path.lstrip('/').split('/', 1)[0].split('?', 1)[0] or 'root'
+        return name if name in self.routes else OTHER
+
+    def start(self, path):
+        """ Call when a request arrives, pass the result to finish() """
+        route = self.routes[self.route_of(path)]
+        with route.lock:
+            route.in_flight += 1
+            if route.in_flight > route.max_in_flight:
+                route.max_in_flight = route.in_flight
+        with self.lock:
+            self.in_flight += 1
+            if self.in_flight > self.max_in_flight:
+                self.max_in_flight = self.in_flight
+        return route, time.perf_counter()
+
+    def finish(self, request, code, bytes_sent):
+        route, start = request
+        seconds = time.perf_counter() - start
+        bucket = 0
+        while bucket < len(BUCKETS) and seconds > BUCKETS[bucket]:
+            bucket += 1
+        with route.lock:
+            route.in_flight -= 1
+            route.requests += 1
+            if code != 200:
+                route.errors += 1
+            route.bytes_sent += bytes_sent
+            route.seconds += seconds
+            route.buckets[bucket] += 1
+        with self.lock:
+            self.in_flight -= 1
+
+    def reset(self):
+        """ Clears everything but the requests in flight """
+        for route in self.routes.values():
+            with route.lock:
+                in_flight = route.in_flight
+                route.reset()
+                route.in_flight = route.max_in_flight = in_flight
+        with self.lock:
+            self.max_in_flight = self.in_flight
+            self.started = time.time()
+        for _, reset in self.gauges.values():
+            if reset is not None:
+                reset()
+
+    def snapshot(self):
+        with self.lock:
+            data = {'since': self.started, 'uptime': time.time() - self.started,
+                    'in_flight': self.in_flight, 'max_in_flight': self.max_in_flight}
+        data['buckets'] = list(BUCKETS)
+        # routes with no requests are left out to keep the reply small
+        data['routes'] = {name: snap for name, route in self.routes.items()
+                          if (snap := route.snapshot())['requests'] or snap['in_flight']}
+        for name, (snapshot, _) in self.gauges.items():
+            data[name] = snapshot()
+        return data
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self):
+        """ Prometheus text exposition format """
+        data = self.snapshot()
+        p = self.prefix
+        lines = [f'# TYPE {p}_in_flight gauge', f'{p}_in_flight {data["in_flight"]}',
+                 f'# TYPE {p}_max_in_flight gauge', f'{p}_max_in_flight {data["max_in_flight"]}']
+        for name in self.gauges:
+            for key, value in data[name].items():
+                lines += [f'# TYPE {p}_{name}_{key} gauge', f'{p}_{name}_{key} {value}']
+        metrics = (('requests_total', 'counter', 'requests'), ('errors_total', 'counter', 'errors'),
+                   ('route_in_flight', 'gauge', 'in_flight'), ('route_max_in_flight', 'gauge', 'max_in_flight'),
+                   ('bytes_sent_total', 'counter', 'bytes_sent'))
+        for metric, kind, key in metrics:
+            lines.append(f'# TYPE {p}_{metric} {kind}')
+            for name, route in data['routes'].items():
+                lines.append(f'{p}_{metric}{{route="{name}"}} {route[key]}')
+
+        lines.append(f'# TYPE {p}_request_seconds histogram')
+        for name, route in data['routes'].items():
+            total = 0
+            for bound, count in zip((*BUCKETS, '+Inf'), route['buckets']):
+                total += count
+                lines.append(f'{p}_request_seconds_bucket{{route="{name}",le="{bound}"}} {total}')
+            lines.append(f'{p}_request_seconds_sum{{route="{name}"}} {route["seconds"]}')
+            lines.append(f'{p}_request_seconds_count{{route="{name}"}} {route["requests"]}')
+        return '\n'.join(lines) + '\n'
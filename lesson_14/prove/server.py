@@ -26,13 +26,40 @@ import json
 import time
 import random
 import threading
-import ast
+import collections
+import atexit
+import itertools
+import argparse
+
+import latency
+from responses import OK, Template
+from route_stats import RouteMetrics
+from array import array
+from urllib.parse import urlsplit, parse_qs
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 hostName = "127.0.0.1"
 serverPort = 8123
 
 SLEEP = 0.25
 MAX_GENERATIONS = 6
+MAX_BATCH_SIZE = 100        # max ids in one /people or /families request
+KEEP_ALIVE = True           # HTTP/1.1 persistent connections
+IDLE_TIMEOUT = 5            # seconds before an idle keep-alive connection is closed
+TREE_SEED = None            # int: same ids and tree every run, tree cached (or --seed <n>, or /start/<gens>?seed=<n>)
+TREE_STORAGE = 'objects'    # 'objects': Person/Family objects, 'compact': typed arrays (much less memory)
+VERBOSE = True              # print/log every request (slow under load)
+LOG_SAMPLE = 1              # with VERBOSE, print/log 1 of every LOG_SAMPLE requests
+STRIPES = 16                # stripes (locks) per request counter
+VECTOR_MIN = 64             # encode_many/decode_many use numpy (if installed) from this many ids
+LOG_BUFFER_LINES = 100000   # log lines waiting for the writer thread
+LOG_FLUSH_LINES = 1000      # write to server.log once this many lines are waiting
+LOG_FLUSH_INTERVAL = 0.5    # or after this many seconds
+LOG_FULL = 'drop'           # buffer full: 'drop' the line or 'block' the request
 
 primes = (5000007787, 5000007797, 5000007799, 5000007811, 5000007823, 5000007829, 5000007877, 5000007899,
             5000007911, 5000007919, 5000007953, 5000007977, 5000007983, 5000008007, 5000008037, 5000008043, 5000008109, 5000008121,
@@ -71,37 +98,60 @@ surnames = ('Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Miller', 'Davis',
             'Pérez', 'Sánchez', 'Ramírez', 'Flores', 'Gómez', 'Torres', 'Díaz', 'Vásquez', 
             'Cruz', 'Morales', 'Gutiérrez', 'Reyes', 'Ruíz', 'Jiménez')
 
+# LatencyModel from the command line (latency.py), None: every request sleeps SLEEP
+latency_model = None
+
+# live per-route numbers for /stats, reset by /start and /stats?reset=1
+metrics = RouteMetrics(('root', 'start', 'end', 'person', 'family', 'people', 'families', 'subtree'),
+                       prefix='family_search')
+
+# reply bodies, see responses.py (person and family records are encoded by CompactTree)
+ROOT_REPLY = Template('start_family_id')
+END_REPLY = Template('people', 'families', 'api', 'threads', 'connections', 'log_dropped', status='OK')
+
 max_thread_count = 0
-call_count = 0
-thread_count = 0
-lock = threading.Lock()
+max_lock = threading.Lock()     # only taken when a new max thread count is seen
+request_numbers = itertools.count()
 
 family_request_order = []
 people = {}
 families = {}
 generations_created = 0
 
+# Replies are encoded once when the tree is built.  index = person/family id
+person_json = []
+family_json = []
+
+# Used instead of the four above when TREE_STORAGE is 'compact'
+compact_tree = None
 
-def get_name_male():
-    return random.choice(male_names)
+# key = (seed, generations), value = (people, families, person_json, family_json, compact_tree)
+tree_cache = {}
 
 
-def get_name_female():
-    return random.choice(female_names)
+START_DATE = datetime.date(1753, 1, 1).toordinal()
+DAYS_BETWEEN_DATES = datetime.date(2020, 1, 1).toordinal() - START_DATE
 
-def get_surname():
-    return random.choice(surnames)
 
-def get_date():
-    start_date = datetime.date(1753, 1, 1)
-    end_date = datetime.date(2020, 1, 1)
+def get_name_male(rng=random):
+    return rng.choice(male_names)
 
-    time_between_dates = end_date - start_date
-    days_between_dates = time_between_dates.days
-    random_number_of_days = random.randrange(days_between_dates)
-    random_date = start_date + datetime.timedelta(days=random_number_of_days)
+
+def get_name_female(rng=random):
+    return rng.choice(female_names)
+
+def get_surname(rng=random):
+    return rng.choice(surnames)
+
+def get_date(rng=random):
+    random_date = datetime.date.fromordinal(START_DATE + rng.randrange(DAYS_BETWEEN_DATES))
     return f'{random_date.day}-{random_date.month}-{random_date.year}'
 
+def get_packed_date(rng=random):
+    # same random draw as get_date(), stored as yyyymmdd
+    random_date = datetime.date.fromordinal(START_DATE + rng.randrange(DAYS_BETWEEN_DATES))
+    return random_date.year * 10000 + random_date.month * 100 + random_date.day
+
 def encode(id: int):
     if id == None:
         return None
@@ -109,41 +159,166 @@ def encode(id: int):
         return (id * ID) ^ PRIME
 
 def decode(code: int):
-    if id == None:
+    if code == None:
         return None
     else:
         return (code ^ PRIME) // ID
 
-class Log:
+def encode_many(ids):
+    """ encode() for a list of int ids, returns a list """
+    if np is not None and len(ids) >= VECTOR_MIN:
+        return ((np.fromiter(ids, np.int64, len(ids)) * ID) ^ PRIME).tolist()
+    key, prime = ID, PRIME
+    return [(id * key) ^ prime for id in ids]
+
+def decode_many(codes):
+    """ decode() for a list of int codes, returns a list """
+    if np is not None and len(codes) >= VECTOR_MIN:
+        return ((np.fromiter(codes, np.int64, len(codes)) ^ PRIME) // ID).tolist()
+    key, prime = ID, PRIME
+    return [(code ^ prime) // key for code in codes]
+
+def set_seed(seed):
+    """
+    Makes PRIME, ID and every tree built without a seed of its own come
+    from seed, so each run of the server gives the same ids and tree
+    """
+    global PRIME
+    global ID
+    global TREE_SEED
+    rng = random.Random(seed)
+    PRIME = rng.choice(primes)
+    ID = rng.randint(10000, 10000000)
+    TREE_SEED = seed
+    # cached replies were encoded with the old keys
+    tree_cache.clear()
 
-    def __init__(self, filename):
+class Log:
+    """
+    Lines are added to a bounded buffer and a background thread writes them
+    to the file in batches, so a request never waits on the disk.  When the
+    buffer is full, LOG_FULL decides: 'drop' the line (counted in dropped)
+    or 'block' the request until the writer catches up.
+    """
+
+    def __init__(self, filename, buffer_lines=LOG_BUFFER_LINES, flush_lines=LOG_FLUSH_LINES,
+                 flush_interval=LOG_FLUSH_INTERVAL, full=LOG_FULL):
         super().__init__()
-        self.lock = threading.Lock()
         self.filename = filename
         self.file = open(filename, 'w')
+        self.buffer_lines = buffer_lines
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_interval
+        self.full = full
+        self.lines = collections.deque()
+        self.dropped = 0
+        self.closed = False
+        self.lock = threading.Condition()
+        self.file_lock = threading.Lock()   # keeps batches in order between the writer and flush()
+        self.writer = threading.Thread(target=self._writer, daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
 
     def write(self, line):
         with self.lock:
-            self.file.write(line)
-            self.file.write('\n')
-            self.file.flush()
-
-    def __del__(self):
+            if len(self.lines) >= self.buffer_lines:
+                if self.full != 'block':
+                    self.dropped += 1
+                    return
+                self.lock.wait_for(lambda: len(self.lines) < self.buffer_lines or self.closed)
+            self.lines.append(line)
+            if len(self.lines) >= self.flush_lines:
+                self.lock.notify_all()
+
+    def _write_batch(self):
+        with self.file_lock:
+            with self.lock:
+                batch = list(self.lines)
+                self.lines.clear()
+                self.lock.notify_all()      # wake requests blocked on a full buffer
+            if batch:
+                self.file.write('\n'.join(batch))
+                self.file.write('\n')
+                self.file.flush()
+
+    def _writer(self):
+        while not self.closed:
+            with self.lock:
+                self.lock.wait_for(lambda: len(self.lines) >= self.flush_lines or self.closed, self.flush_interval)
+            self._write_batch()
+
+    def flush(self):
+        """ Writes everything buffered so far before returning """
+        self._write_batch()
+
+    def close(self):
+        if self.closed:
+            return
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        self.writer.join()
+        self._write_batch()
         self.file.close()
 
 # Global log object
 log = Log('server.log')
 
+# ----------------------------------------------------------------------------
+_stripe_numbers = itertools.count()
+_thread_data = threading.local()
+
+def _thread_stripe():
+    # every thread is given the next stripe number the first time it counts
+    try:
+        return _thread_data.stripe
+    except AttributeError:
+        _thread_data.stripe = next(_stripe_numbers)
+        return _thread_data.stripe
+
+
+class StripedCounter:
+    """
+    Counter split into stripes, each with its own lock.  A thread always adds
+    to the same stripe so threads only wait on each other when they share
+    one.  value() adds up the stripes without taking any lock.
+    """
+
+    def __init__(self, stripes=STRIPES):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        self.counts = [0] * stripes
+
+    def add(self, amount=1):
+        stripe = _thread_stripe() % len(self.counts)
+        with self.locks[stripe]:
+            self.counts[stripe] += amount
+
+    def value(self):
+        return sum(self.counts)
+
+    def reset(self, value=0):
+        for lock in self.locks:
+            lock.acquire()
+        self.counts = [0] * len(self.counts)
+        self.counts[0] = value
+        for lock in self.locks:
+            lock.release()
+
+# Global request counters
+call_count = StripedCounter()
+thread_count = StripedCounter()
+connection_count = StripedCounter()
+
 # ----------------------------------------------------------------------------
 class Person:
     
-    def __init__(self, id, name):
+    def __init__(self, id, name, birth=None):
         super().__init__()
         self.id = id
         self.name = name
         self.parents = None
         self.family = None
-        self.birth = get_date()
+        self.birth = get_date() if birth is None else birth
 
     def add_birth(self, date_str):
         self.birth = date_str
@@ -211,13 +386,301 @@ class Family:
 
 
 # ----------------------------------------------------------------------------
-def build_tree(gens):
+NAMES = male_names + female_names
+NAME_INDEX = {name: index for index, name in enumerate(NAMES)}
+NAME_JSON = [json.dumps(name) for name in NAMES]
+
+
+class CompactTree:
+    """
+    Column version of the people and families dicts.  Every field is a typed
+    array indexed by id (0 = None), names are indexes into NAMES and birth
+    dates are packed as yyyymmdd.  The children of family f are
+    child_ids[child_start[f]:child_start[f + 1]].  Replies are built from the
+    arrays when requested instead of being kept as bytes.
+    """
+    __slots__ = ('name', 'birth', 'parents', 'family', 'husband', 'wife', 'child_start', 'child_ids')
+
+    def __init__(self):
+        self.name = array('B', [0])
+        self.birth = array('i', [0])
+        self.parents = array('i', [0])
+        self.family = array('i', [0])
+        self.husband = array('i', [0])
+        self.wife = array('i', [0])
+        self.child_start = array('i', [0])
+        self.child_ids = array('i')
+
+    def add_person(self, name, birth):
+        self.name.append(NAME_INDEX[name])
+        self.birth.append(birth)
+        self.parents.append(0)
+        self.family.append(0)
+        return len(self.name) - 1
+
+    def add_family(self, husband, wife):
+        self.husband.append(husband)
+        self.wife.append(wife)
+        id = len(self.husband) - 1
+        self.family[husband] = id
+        self.family[wife] = id
+        return id
+
+    def index_children(self, child_family, child_person):
+        # counting sort of the (family, child) pairs, stable so every family
+        # keeps its children in the order they were added
+        start = array('i', [0]) * (len(self.husband) + 1)
+        for family in child_family:
+            start[family + 1] += 1
+        for family in range(1, len(start)):
+            start[family] += start[family - 1]
+
+        child_ids = array('i', [0]) * len(child_person)
+        next_slot = array('i', start)
+        for family, child in zip(child_family, child_person):
+            child_ids[next_slot[family]] = child
+            next_slot[family] += 1
+
+        self.child_start = start
+        self.child_ids = child_ids
+
+    def person_count(self):
+        return len(self.name) - 1
+
+    def family_count(self):
+        return len(self.husband) - 1
+
+    def person_json(self, id):
+        if not 0 < id < len(self.name):
+            return None
+        birth = self.birth[id]
+        parents = self.parents[id]
+        family = self.family[id]
+        return bytes(f'{{"id": {encode(id)}, "name": {NAME_JSON[self.name[id]]}, '
+                     f'"birth": "{birth % 100}-{birth // 100 % 100}-{birth // 10000}", '
+                     f'"parent_id": {encode(parents) if parents else "null"}, '
+                     f'"family_id": {encode(family) if family else "null"}}}', 'utf8')
+
+    def family_members(self, id):
+        if not 0 < id < len(self.husband):
+            return None
+        husband = self.husband[id]
+        wife = self.wife[id]
+        person_ids = [husband, wife, *self.child_ids[self.child_start[id]:self.child_start[id + 1]]]
+        parent_ids = [self.parents[pid] for pid in (husband, wife) if self.parents[pid]]
+        return person_ids, parent_ids
+
+    def people_json(self, ids):
+        """ person_json() for a batch, every id in it is encoded with one encode_many() """
+        valid = [id for id in ids if 0 < id < len(self.name)]
+        codes = iter(encode_many([value for id in valid for value in (id, self.parents[id], self.family[id])]))
+        records = {}
+        for id in valid:
+            code, parents, family = next(codes), next(codes), next(codes)
+            birth = self.birth[id]
+            records[id] = bytes(f'{{"id": {code}, "name": {NAME_JSON[self.name[id]]}, '
+                                f'"birth": "{birth % 100}-{birth // 100 % 100}-{birth // 10000}", '
+                                f'"parent_id": {parents if self.parents[id] else "null"}, '
+                                f'"family_id": {family if self.family[id] else "null"}}}', 'utf8')
+        return [records.get(id) for id in ids]
+
+    def families_json(self, ids):
+        """ family_json() for a batch, every id in it is encoded with one encode_many() """
+        valid = [id for id in ids if 0 < id < len(self.husband)]
+        start = self.child_start
+        codes = iter(encode_many([value for id in valid
+                                  for value in (id, self.husband[id], self.wife[id], *self.child_ids[start[id]:start[id + 1]])]))
+        records = {}
+        for id in valid:
+            code, husband, wife = next(codes), next(codes), next(codes)
+            children = ', '.join(str(next(codes)) for _ in range(start[id + 1] - start[id]))
+            records[id] = bytes(f'{{"id": {code}, "husband_id": {husband if self.husband[id] else "null"}, '
+                                f'"wife_id": {wife if self.wife[id] else "null"}, "children": [{children}]}}', 'utf8')
+        return [records.get(id) for id in ids]
+
+    def family_json(self, id):
+        if not 0 < id < len(self.husband):
+            return None
+        husband = self.husband[id]
+        wife = self.wife[id]
+        children = ', '.join(str(encode(child)) for child in self.child_ids[self.child_start[id]:self.child_start[id + 1]])
+        return bytes(f'{{"id": {encode(id)}, "husband_id": {encode(husband) if husband else "null"}, '
+                     f'"wife_id": {encode(wife) if wife else "null"}, "children": [{children}]}}', 'utf8')
+
+# ----------------------------------------------------------------------------
+def get_person_json(id):
+    if compact_tree is not None:
+        return compact_tree.person_json(id)
+    if 0 < id < len(person_json):
+        return person_json[id]
+    return None
+
+
+def get_family_json(id):
+    if compact_tree is not None:
+        return compact_tree.family_json(id)
+    if 0 < id < len(family_json):
+        return family_json[id]
+    return None
+
+
+def get_people_json(ids):
+    if compact_tree is not None:
+        return compact_tree.people_json(ids)
+    return [get_person_json(id) for id in ids]
+
+
+def get_families_json(ids):
+    if compact_tree is not None:
+        return compact_tree.families_json(ids)
+    return [get_family_json(id) for id in ids]
+
+
+def get_family_members(id):
+    """ Returns ([husband, wife, children...], [parent family ids]) or None """
+    if compact_tree is not None:
+        return compact_tree.family_members(id)
+    if id not in families:
+        return None
+    family = families[id]
+    person_ids = [family.husband, family.wife] + [child.id for child in family.children]
+    parent_ids = [people[pid].parents for pid in (family.husband, family.wife) if people[pid].parents]
+    return person_ids, parent_ids
+
+
+def get_subtree_ndjson(family_id, depth):
+    """
+    Walks the ancestors of family_id breadth first for depth generations.
+    Yields (family id, chunk) where chunk is the NDJSON lines of the family
+    and its people: {"family": {...}} then {"person": {...}} for each person.
+    A husband or wife is sent with their own family and not again as a
+    child of their parents' family, so every person is in the stream once.
+    """
+    seen = {family_id}
+    sent_people = set()
+    generation = [family_id]
+    for _ in range(depth):
+        next_generation = []
+        for id in generation:
+            members = get_family_members(id)
+            if members is None:
+                continue
+            person_ids, parent_ids = members
+
+            lines = [b'{"family": ' + get_family_json(id) + b'}\n']
+            for pid in person_ids:
+                if pid not in sent_people:
+                    sent_people.add(pid)
+                    lines.append(b'{"person": ' + get_person_json(pid) + b'}\n')
+            yield id, b''.join(lines)
+
+            for parent_id in parent_ids:
+                if parent_id not in seen:
+                    seen.add(parent_id)
+                    next_generation.append(parent_id)
+        generation = next_generation
+
+
+def get_people_count():
+    return compact_tree.person_count() if compact_tree is not None else len(people)
+
+
+def get_families_count():
+    return compact_tree.family_count() if compact_tree is not None else len(families)
+
+
+def get_batch_json(records):
+    # records are already encoded, only the list around them is built here
+    return b'[' + b', '.join(b'null' if record is None else record for record in records) + b']'
+
+
+def encode_records(records):
+    output = [None] * (len(records) + 1)
+    for id, record in records.items():
+        output[id] = bytes(json.dumps(record.get_dict()), 'utf8')
+    return output
+
+
+# ----------------------------------------------------------------------------
+def build_compact_tree(gens, rng):
+    # Same steps (and random draws) as build_tree() so a seed gives the same tree
+    tree = CompactTree()
+    child_family = array('i')
+    child_person = array('i')
+
+    def _create_family(generation):
+        if generation < 1:
+            return
+
+        husband = tree.add_person(get_name_male(rng), get_packed_date(rng))
+        wife = tree.add_person(get_name_female(rng), get_packed_date(rng))
+        family = tree.add_family(husband, wife)
+
+        number_children = rng.randint(2, 8)
+        for i in range(number_children):
+
+            if rng.randint(1, 2) == 1:
+                child = tree.add_person(get_name_male(rng), get_packed_date(rng))
+            else:
+                child = tree.add_person(get_name_female(rng), get_packed_date(rng))
+
+            child_family.append(family)
+            child_person.append(child)
+
+        if generation > 1:
+            husband_parents = _create_family(generation - 1)
+            tree.parents[husband] = husband_parents
+            child_family.append(husband_parents)
+            child_person.append(husband)
+
+            wife_parents = _create_family(generation - 1)
+            tree.parents[wife] = wife_parents
+            child_family.append(wife_parents)
+            child_person.append(wife)
+
+        return family
+
+    _create_family(gens)
+    tree.index_children(child_family, child_person)
+    return tree
+
+
+def build_tree(gens, seed=None):
     global people
     global families
+    global person_json
+    global family_json
+    global compact_tree
     global log
 
+    if seed is not None and (seed, gens) in tree_cache:
+        people, families, person_json, family_json, compact_tree = tree_cache[(seed, gens)]
+        print(f'Using cached tree for seed {seed}')
+        log.write(f'Using cached tree for seed {seed}')
+        print(f'Number of people  : {get_people_count()}')
+        print(f'Number of families: {get_families_count()}')
+        log.write(f'Number of people  : {get_people_count()}')
+        log.write(f'Number of families: {get_families_count()}')
+        return
+
+    # a seeded tree has its own random generator so it is the same every time
+    rng = random if seed is None else random.Random(seed)
+
     people = {}
     families = {}
+    person_json = []
+    family_json = []
+    compact_tree = None
+
+    if TREE_STORAGE == 'compact':
+        compact_tree = build_compact_tree(gens, rng)
+        if seed is not None:
+            tree_cache[(seed, gens)] = (people, families, person_json, family_json, compact_tree)
+        print(f'Number of people  : {get_people_count()}')
+        print(f'Number of families: {get_families_count()}')
+        log.write(f'Number of people  : {get_people_count()}')
+        log.write(f'Number of families: {get_families_count()}')
+        return
 
     next_person_id = 1
     next_family_id = 1
@@ -231,11 +694,11 @@ def build_tree(gens):
         if generation < 1:
             return
 
-        husband = Person(next_person_id, get_name_male())
+        husband = Person(next_person_id, get_name_male(rng), get_date(rng))
         people[next_person_id] = husband
         next_person_id += 1
 
-        wife = Person(next_person_id, get_name_female())
+        wife = Person(next_person_id, get_name_female(rng), get_date(rng))
         people[next_person_id] = wife
         next_person_id += 1
 
@@ -245,13 +708,13 @@ def build_tree(gens):
         families[next_family_id] = family
         next_family_id += 1
 
-        number_children = random.randint(2, 8)
+        number_children = rng.randint(2, 8)
         for i in range(number_children):
 
-            if random.randint(1, 2) == 1:
-                child = Person(next_person_id, get_name_male())
+            if rng.randint(1, 2) == 1:
+                child = Person(next_person_id, get_name_male(rng), get_date(rng))
             else:
-                child = Person(next_person_id, get_name_female())
+                child = Person(next_person_id, get_name_female(rng), get_date(rng))
 
             people[next_person_id] = child
             family.add_child(child)
@@ -273,6 +736,11 @@ def build_tree(gens):
 
     _create_family(gens)
 
+    person_json = encode_records(people)
+    family_json = encode_records(families)
+    if seed is not None:
+        tree_cache[(seed, gens)] = (people, families, person_json, family_json, compact_tree)
+
     print(f'Number of people  : {len(people)}')
     print(f'Number of families: {len(families)}')
     log.write(f'Number of people  : {len(people)}')
@@ -282,55 +750,113 @@ def build_tree(gens):
 # ----------------------------------------------------------------------------
 class Handler(BaseHTTPRequestHandler):
 
-    def get_person(self, id):
-        global people
-        if id in people:
-            return people[id].get_dict()
+    # HTTP/1.1 keeps the connection open between requests as long as every
+    # reply has a Content-Length.  timeout closes idle connections.
+    protocol_version = 'HTTP/1.1' if KEEP_ALIVE else 'HTTP/1.0'
+    timeout = IDLE_TIMEOUT
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        connection_count.add(1)
+
+    def log_request(self, code='-', size='-'):
+        # the one line per request printed by BaseHTTPRequestHandler
+        if VERBOSE:
+            super().log_request(code, size)
+
+    def send_reply(self, code, body=b'', content_type='application/json'):
+        self.reply_code = code
+        self.bytes_sent += len(body)
+        self.send_response(code)
+        self.send_header("Content-type",  content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def send_stream(self, chunks):
+        # Chunked transfer needs HTTP/1.1, otherwise the end of the reply is
+        # marked by closing the connection
+        chunked = self.protocol_version == 'HTTP/1.1' and self.request_version == 'HTTP/1.1'
+        self.reply_code = 200
+        self.send_response(200)
+        self.send_header("Content-type",  "application/x-ndjson")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
         else:
-            return None
-
-
-    def get_family(self, id):
-        global families
-        if id in families:
-            return families[id].get_dict()
+            self.send_header("Connection", "close")
+        self.end_headers()
+        for chunk in chunks:
+            self.bytes_sent += len(chunk)
+            if chunked:
+                self.wfile.write(b'%x\r\n%b\r\n' % (len(chunk), chunk))
+            else:
+                self.wfile.write(chunk)
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def send_stats(self):
+        # not counted as an API call and never delayed
+        query = parse_qs(urlsplit(self.path).query)
+        if 'reset' in query:
+            metrics.reset()
+        if query.get('format', [''])[0] == 'prometheus':
+            self.send_reply(200, metrics.to_prometheus().encode('utf8'), 'text/plain; version=0.0.4')
         else:
-            return None
- 
+            self.send_reply(200, metrics.to_json().encode('utf8'))
+
     def do_GET(self):
-        global thread_count
-        global lock
         global max_thread_count
-        global call_count
-        global family_request_order
-        global log
-        global generations_created
 
-        with lock:
-            thread_count += 1
-            call_count += 1
-            if thread_count > max_thread_count:
-                max_thread_count = thread_count
-            print(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
-            log.write(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
+        self.reply_code = None
+        self.bytes_sent = 0
+        if self.path.startswith('/stats'):
+            self.send_stats()
+            return
+
+        request = metrics.start(self.path)
+        call_count.add(1)
+        thread_count.add(1)
+        active = thread_count.value()
+        if active > max_thread_count:
+            with max_lock:
+                if active > max_thread_count:
+                    max_thread_count = active
 
-        print('- ' * 35)
-        print(f'Request: {self.path}')
+        verbose = VERBOSE and next(request_numbers) % LOG_SAMPLE == 0
+        if verbose:
+            print(f'Current: active threads / max count: {active} / {max_thread_count}')
+            log.write(f'Current: active threads / max count: {active} / {max_thread_count}')
 
-        log.write(f'Request: {self.path}')
+            print('- ' * 35)
+            print(f'Request: {self.path}')
+
+            log.write(f'Request: {self.path}')
+
+        try:
+            self.handle_get(verbose)
+        finally:
+            thread_count.add(-1)
+            metrics.finish(request, self.reply_code, self.bytes_sent)
+
+    def handle_get(self, verbose):
+        global max_thread_count
+        global family_request_order
+        global log
+        global generations_created
 
-        if SLEEP > 0:
+        if latency_model is not None:
+            latency_model.wait(latency.endpoint_of(self.path))
+        elif SLEEP > 0:
             time.sleep(SLEEP)
 
         if 'start' in self.path:
             family_request_order = []
-            parts = self.path.split('/')
+            url = urlsplit(self.path)
+            parts = url.path.split('/')
             if len(parts) < 3:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
+                self.send_reply(404)
                 return
 
             try:
@@ -338,29 +864,36 @@ class Handler(BaseHTTPRequestHandler):
             except:
                 generations = MAX_GENERATIONS
 
+            try:
+                seed = int(parse_qs(url.query)['seed'][0])
+            except:
+                seed = TREE_SEED
+
             output = f'Creating family tree with {generations} generations...'
             print(output)
             log.write(output)
 
             generations_created = generations
-            build_tree(generations)
+            build_tree(generations, seed)
 
             max_thread_count = 1
-            thread_count = 1
-            call_count = 1
+            thread_count.reset(1)
+            call_count.reset(1)
+            connection_count.reset(1)
+            metrics.reset()
 
-            json_data = '{"status":"OK"}'
+            json_data = OK
 
                     
         elif 'end' in self.path:
             print('#' * 80)
             log.write('#' * 80)
 
-            print(f'Total number of people  : {len(people)}')
-            print(f'Total number of families: {len(families)}')
+            print(f'Total number of people  : {get_people_count()}')
+            print(f'Total number of families: {get_families_count()}')
             print(f'Number of generations   : {generations_created}')
-            log.write(f'Total number of people  : {len(people)}')
-            log.write(f'Total number of families: {len(families)}')
+            log.write(f'Total number of people  : {get_people_count()}')
+            log.write(f'Total number of families: {get_families_count()}')
             log.write(f'Number of generations   : {generations_created}')
 
 
@@ -371,19 +904,72 @@ class Handler(BaseHTTPRequestHandler):
             print(output)
             log.write(output)
 
-            print(f'Total number of API calls: {call_count}')
-            log.write(f'Total number of API calls: {call_count}')
+            calls = call_count.value()
+            connections = connection_count.value()
+
+            print(f'Total number of API calls: {calls}')
+            log.write(f'Total number of API calls: {calls}')
 
             print(f'Final thread count (max count): {max_thread_count}')
             log.write(f'Final thread count (max count): {max_thread_count}')
 
-            data_str = '{' + \
-                       f'"status":"OK", "people": {len(people)}, "families": {len(families)}, "api": {call_count}, "threads": {max_thread_count}' + \
-                       '}'
-            json_data = json.dumps(ast.literal_eval(data_str))
+            print(f'Connections (requests/conn)   : {connections} ({calls / connections:.2f})')
+            log.write(f'Connections (requests/conn)   : {connections} ({calls / connections:.2f})')
+
+            print(f'Log lines dropped             : {log.dropped}')
+            log.write(f'Log lines dropped             : {log.dropped}')
+
+            json_data = END_REPLY.render(get_people_count(), get_families_count(), calls, max_thread_count,
+                                         connections, log.dropped)
 
             print('#' * 80)
             log.write('#' * 80)
+            log.flush()
+
+        elif self.path.startswith('/subtree'):
+            # /subtree/<family id>/<depth>: the family and its ancestors as NDJSON
+            # (one API call and one SLEEP for the whole subtree)
+            parts = self.path.split('/')
+            try:
+                id = decode(int(parts[2]))
+                depth = int(parts[3])
+            except:
+                id = None
+
+            if id == None or get_family_members(id) is None:
+                self.send_reply(404)
+                return
+
+            if verbose:
+                print(f'Streaming subtree of family {id}, depth {depth}')
+                log.write(f'Streaming subtree of family {id}, depth {depth}')
+
+            def _chunks():
+                for family_id, chunk in get_subtree_ndjson(id, depth):
+                    family_request_order.append(family_id)
+                    yield chunk
+
+            self.send_stream(_chunks())
+            return
+
+        elif self.path.startswith('/people') or self.path.startswith('/families'):
+            # Batch request: /people?ids=<id>,<id>,...  or  /families?ids=<id>,<id>,...
+            # One API call (and one SLEEP) for the whole list of ids
+            query = parse_qs(urlsplit(self.path).query)
+            try:
+                ids = decode_many([int(code) for code in query['ids'][0].split(',') if code != ''])
+            except:
+                ids = None
+
+            if not ids or len(ids) > MAX_BATCH_SIZE:
+                self.send_reply(404)
+                return
+
+            if self.path.startswith('/people'):
+                json_data = get_batch_json(get_people_json(ids))
+            else:
+                json_data = get_batch_json(get_families_json(ids))
+                family_request_order.extend(ids)
 
         elif 'person' in self.path or 'family' in self.path:
             parts = self.path.split('/')
@@ -391,11 +977,7 @@ class Handler(BaseHTTPRequestHandler):
             # print(parts)
 
             if len(parts) < 3:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
+                self.send_reply(404)
                 return
 
             try:
@@ -404,46 +986,30 @@ class Handler(BaseHTTPRequestHandler):
                 id = None
 
             if id == None:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
+                self.send_reply(404)
                 return
 
             if 'person' in self.path:
-                data = self.get_person(id)
+                json_data = get_person_json(id)
             else:
-                data = self.get_family(id)
+                json_data = get_family_json(id)
                 family_request_order.append(id)
-
-            if data != None:
-                json_data = json.dumps(data)
-            else:
-                json_data = None
         else:
             start_id = 1 # random.randint(1, 100000)
-            data = {"start_family_id" : encode(start_id)}
-            json_data = json.dumps(data)
+            json_data = ROOT_REPLY.render(encode(start_id))
 
         if json_data == None:
-            self.send_response(404)
-            self.send_header("Content-type",  "application/json")
-            self.end_headers()
+            self.send_reply(404)
         else:
-            print('Sending:', json_data)
-            log.write(f'Sending: {json_data}')
-
-            self.send_response(200)
-            self.send_header("Content-type",  "application/json")
-            self.end_headers()
-            self.wfile.write(bytes(json_data, "utf8"))
+            if verbose:
+                print('Sending:', json_data.decode("utf8"))
+                log.write(f'Sending: {json_data.decode("utf8")}')
 
-        with lock:
-            thread_count -= 1
+            self.send_reply(200, json_data)
 
 class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    pass
+    # keep-alive threads must not stop the server from exiting
+    daemon_threads = True
 
 if __name__ == '__main__':
     # random.seed(101)
@@ -454,6 +1020,18 @@ if __name__ == '__main__':
     # for id in families:
     #     print(families[id])
 
+    parser = argparse.ArgumentParser(description='Family Search server')
+    parser.add_argument('--seed', type=int, default=TREE_SEED,
+                        help='same ids, tree shape, names and dates on every run')
+    latency.add_arguments(parser, SLEEP)
+    args = parser.parse_args()
+    if args.seed is not None:
+        set_seed(args.seed)
+    latency_model = latency.from_args(parser, args)
+    print(f'Latency: {latency_model}')
+    # capacity queue depth in /stats
+    metrics.add_gauges('latency', latency_model.metrics, latency_model.reset_metrics)
+
     server = ThreadingSimpleServer((hostName, serverPort), Handler)
     print('Starting Family Search server, use <Ctrl-C> or <Command-C> to stop')
     print(f'URL = {hostName}:{serverPort}\n')